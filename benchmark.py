@@ -0,0 +1,265 @@
+# Benchmarks the main routes against a throwaway PostgreSQL cluster.
+#
+#   python benchmark.py --output results.json
+#   python benchmark.py --sizes 10000 --baseline results.json
+#
+# initdb and pg_ctl are taken from --pg-bin, `pg_config --bindir` or PATH.
+# PostgreSQL refuses to run as root; use --host/--port to benchmark against
+# an already running server instead (the bench_* tables are recreated there).
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import click
+import psycopg2
+
+import main
+
+SIZES = (10000, 1000000, 10000000)
+
+# name -> (column definitions, SELECT expressions over generate_series(1, n) AS i)
+SCHEMAS = {
+    'narrow': (
+        ['id serial PRIMARY KEY', 'name text', 'value integer'],
+        ["'name ' || i", 'i % 1000'],
+    ),
+    'wide': (
+        ['id serial PRIMARY KEY']
+        + [f'int_{n} integer' for n in range(8)]
+        + [f'text_{n} text' for n in range(8)]
+        + [f'num_{n} numeric(12, 2)' for n in range(4)]
+        + [f'ts_{n} timestamp' for n in range(4)]
+        + ['flag boolean', 'payload text'],
+        [f'(i * {n + 7}) % 100000' for n in range(8)]
+        + [f"md5((i + {n})::text)" for n in range(8)]
+        + [f'(i % 10000) / 100.0 + {n}' for n in range(4)]
+        + [f"timestamp '2020-01-01' + (i % 100000) * interval '{n + 1} minute'" for n in range(4)]
+        + ['i % 2 = 0', "repeat('x', 200)"],
+    ),
+}
+
+
+def find_pg_bin(pg_bin):
+    if pg_bin:
+        return pg_bin
+    pg_config = shutil.which('pg_config')
+    if pg_config:
+        return subprocess.check_output([pg_config, '--bindir'], text=True).strip()
+    initdb = shutil.which('initdb')
+    if initdb:
+        return os.path.dirname(initdb)
+    raise click.ClickException('initdb was not found; pass --pg-bin')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+class Cluster():
+
+    def __init__(self, pg_bin):
+        self.pg_bin = pg_bin
+        self.directory = tempfile.mkdtemp(prefix='pgweb-bench-')
+        self.data = os.path.join(self.directory, 'data')
+        self.host = 'localhost'
+        self.port = free_port()
+
+    def run(self, program, *args):
+        subprocess.run([os.path.join(self.pg_bin, program)] + list(args), check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def start(self):
+        self.run('initdb', '-D', self.data, '-U', 'postgres', '-A', 'trust', '--no-sync')
+        options = (f'-p {self.port} -k {self.directory} -c fsync=off -c synchronous_commit=off '
+                   f'-c full_page_writes=off -c shared_buffers=256MB')
+        self.run('pg_ctl', '-D', self.data, '-o', options, '-l', os.path.join(self.directory, 'log'), '-w', 'start')
+
+    def stop(self):
+        try:
+            self.run('pg_ctl', '-D', self.data, '-m', 'immediate', '-w', 'stop')
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def seed(conn, schema, size):
+    columns, expressions = SCHEMAS[schema]
+    table = f'bench_{schema}_{size}'
+    names = [column.split()[0] for column in columns[1:]]
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {table}')
+        cursor.execute(f'CREATE TABLE {table} ({", ".join(columns)})')
+        cursor.execute(f'INSERT INTO {table} ({", ".join(names)}) '
+                       f'SELECT {", ".join(expressions)} FROM generate_series(1, {int(size)}) AS i')
+    conn.commit()
+    # VACUUM can't run in a transaction; it sets the visibility map like a settled table
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f'VACUUM ANALYZE {table}')
+    finally:
+        conn.autocommit = False
+    return table
+
+
+def row_form(tools, table, next_id):
+    form = {}
+    for column in tools.get_table_info(table):
+        if column.name == 'id':
+            form['id'] = str(next_id)
+        elif column.data_type in ('integer', 'numeric'):
+            form[column.name] = '1'
+        elif column.data_type.startswith('timestamp'):
+            form[column.name] = '2024-01-01T00:00'
+        elif column.data_type == 'boolean':
+            form[column.name] = 'true'
+        else:
+            form[column.name] = 'benchmark'
+    return form
+
+
+def scenarios(tools, table, size):
+    text_column = 'name' if '_narrow_' in table else 'text_0'
+    deep_page = max(1, size // main.app.config['ROWS_PER_PAGE'] // 2)
+    # The view mode grid loads its rows from /rows, so pages with rows are timed in edit mode
+    deep_window = max(1, size // main.app.config['ROWS_API_LIMIT'] // 2)
+    deep_cursor = main.encode_cursor([size // 2])
+    next_id = iter(range(size + 1, size + 1000000))
+    return {
+        'table_content_first': lambda client: client.get(f'/{table}/edit/content'),
+        'table_content_deep': lambda client: client.get(f'/{table}/edit/content?page={deep_page}'),
+        'rows_first': lambda client: client.get(f'/{table}/rows'),
+        'rows_deep_offset': lambda client: client.get(f'/{table}/rows?page={deep_window}'),
+        'rows_deep_keyset': lambda client: client.get(f'/{table}/rows?after={deep_cursor}'),
+        'table_info': lambda client: client.get(f'/{table}'),
+        'table_query': lambda client: client.post(f'/{table}/query/', data={
+            'sql': f'SELECT * FROM {table} WHERE id BETWEEN {size // 2} AND {size // 2 + 100}'}),
+        'add_row': lambda client: client.post(f'/{table}/view/add-row/', data=row_form(tools, table, next(next_id))),
+        'apply_changes': lambda client: client.post(f'/{table}/apply-changes', json={'changes': [
+            {'pk': [row_id], 'column': text_column, 'value': f'edited {time.time()}'}
+            for row_id in range(1, 51)]}),
+    }
+
+
+def measure(client, request, repeat):
+    request(client)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = request(client)
+        timings.append((time.perf_counter() - started) * 1000)
+        if response.status_code >= 400:
+            raise click.ClickException(f'{response.request.path} returned {response.status_code}')
+    # Allocation tracing slows Python code down, so memory is measured in a separate run
+    tracemalloc.start()
+    request(client)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    timings.sort()
+    return {
+        'median_ms': round(statistics.median(timings), 3),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+        'min_ms': round(timings[0], 3),
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for table, routes in results['results'].items():
+        for route, current in routes.items():
+            previous = baseline.get('results', {}).get(table, {}).get(route)
+            if previous is None:
+                continue
+            for metric in ('median_ms', 'peak_kb'):
+                if previous[metric] and current[metric] > previous[metric] * (1 + threshold):
+                    regressions.append((table, route, metric, previous[metric], current[metric]))
+    return regressions
+
+
+@click.command()
+@click.option('--sizes', default=','.join(map(str, SIZES)), help='Comma-separated table sizes in rows.')
+@click.option('--schemas', default=','.join(SCHEMAS), help='Comma-separated table schemas.')
+@click.option('--repeat', default=10, help='Timed runs per route.')
+@click.option('--pg-bin', default=None, help='Directory with initdb and pg_ctl.')
+@click.option('--host', default=None, help='Use a running server instead of a throwaway cluster.')
+@click.option('--port', default=5432)
+@click.option('--user', default='postgres')
+@click.option('--password', default='')
+@click.option('--dbname', default='postgres')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write results as JSON to this file.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='Results to compare against.')
+@click.option('--threshold', default=0.2, help='Allowed slowdown over the baseline, as a fraction.')
+def benchmark(sizes, schemas, repeat, pg_bin, host, port, user, password, dbname, output, baseline, threshold):
+    cluster = None
+    if host is None:
+        cluster = Cluster(find_pg_bin(pg_bin))
+        cluster.start()
+        host, port, user, password, dbname = cluster.host, cluster.port, 'postgres', '', 'postgres'
+    try:
+        conn = psycopg2.connect(dbname=dbname, user=user, password=password, host=host, port=port)
+        tables = []
+        for size in [int(size) for size in sizes.split(',')]:
+            for schema in schemas.split(','):
+                click.echo(f'Seeding {schema} table with {size} rows', err=True)
+                tables.append((seed(conn, schema, size), size))
+        server_version = conn.server_version
+        conn.close()
+
+        # Log in like a browser, so the database belongs to the client's session
+        client = main.app.test_client()
+        client.post('/', data={'dbname': dbname, 'username': user, 'password': password,
+                               'host': host, 'port': str(port)})
+        with client.session_transaction() as session:
+            tools = main.sessions.get(session.get('connection'))
+        if tools is None:
+            raise click.ClickException(f'Could not connect to {dbname} on {host}:{port}')
+        results = {
+            'meta': {
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'server_version': server_version,
+                'repeat': repeat,
+            },
+            'results': {},
+        }
+        for table, size in tables:
+            routes = results['results'][table] = {}
+            for route, request in scenarios(tools, table, size).items():
+                routes[route] = measure(client, request, repeat)
+                click.echo(f'{table:28} {route:22} {routes[route]["median_ms"]:10.2f} ms '
+                           f'{routes[route]["peak_kb"]:10.1f} KB', err=True)
+        client.get('/close')
+    finally:
+        if cluster is not None:
+            cluster.stop()
+
+    report = json.dumps(results, indent=2)
+    if output:
+        with open(output, 'w') as file:
+            file.write(report + '\n')
+    else:
+        click.echo(report)
+
+    if baseline:
+        with open(baseline) as file:
+            regressions = compare(results, json.load(file), threshold)
+        for table, route, metric, previous, current in regressions:
+            click.echo(f'REGRESSION {table} {route} {metric}: {previous} -> {current}', err=True)
+        if regressions:
+            sys.exit(1)
+        click.echo('No regressions against the baseline', err=True)
+
+
+if __name__ == '__main__':
+    benchmark()
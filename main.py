@@ -1,42 +1,1316 @@
+import base64
+import csv
+import difflib
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import math
+import os
+import queue
 import re
+import select
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from functools import wraps
 from markupsafe import Markup
 import psycopg2
-from flask import (Flask, render_template, request, abort, flash, redirect, url_for, jsonify)
-from pygments import formatters, highlight, lexers
+from psycopg2 import errors as pg_errors
+from psycopg2 import extensions
+from psycopg2 import sql as pg_sql
+from psycopg2.pool import PoolError
+import click
+from flask import (Flask, Response, render_template, request, abort, flash, redirect, url_for, jsonify,
+                   send_file, stream_with_context, g, has_request_context, make_response, session)
+from werkzeug.local import LocalProxy
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# (highlight, lexer, formatter), set up on first use: Pygments is slow to import
+_sql_highlighter = None
+
+
 def syntax_highlight(data):
+    global _sql_highlighter
     if not data:
         return ''
-    lexer = lexers.get_lexer_by_name('sql')
-    formatter = formatters.HtmlFormatter(linenos=False)
+    if _sql_highlighter is None:
+        from pygments import formatters, highlight, lexers
+        _sql_highlighter = (highlight, lexers.get_lexer_by_name('sql'), formatters.HtmlFormatter(linenos=False))
+    highlight, lexer, formatter = _sql_highlighter
     return highlight(data, lexer, formatter)
 
 
 DEBUG = True
 MAX_RESULT_SIZE = 50
+# Console limits: rows are fetched QUERY_FETCH_SIZE at a time from a server-side
+# cursor until MAX_RESULT_SIZE rows or MAX_RESULT_BYTES of values are read
+MAX_RESULT_BYTES = 2 * 1024 * 1024
+QUERY_FETCH_SIZE = 500
+QUERY_TIMEOUT = 30000
+# Exports stream through a queue of at most EXPORT_QUEUE_SIZE chunks
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_QUEUE_SIZE = 16
+# Imports COPY this many rows per savepoint; 'batch' mode also commits each one
+IMPORT_BATCH_SIZE = 10000
+IMPORT_HISTORY_SIZE = 20
 ROWS_PER_PAGE = 40
-
-app = Flask(__name__)
+EXACT_COUNT_THRESHOLD = 100000
+ROW_COUNT_CACHE_TTL = 60
+# Filters that read the whole table suggest an index on tables at least this big
+FILTER_HINT_MIN_ROWS = 10000
+# Rows per request of the row API behind the scrolling grid
+ROWS_API_LIMIT = 200
+ROWS_API_MAX = 2000
+INDEX_METHODS = ('btree', 'hash', 'gin', 'gist', 'brin', 'spgist')
+INDEX_HISTORY_SIZE = 20
+# ANALYZE from the profile page reads 300 * PROFILE_STATISTICS_TARGET sampled rows;
+# the preview shows PREVIEW_ROWS rows from a TABLESAMPLE SYSTEM block sample
+PROFILE_STATISTICS_TARGET = 100
+PREVIEW_ROWS = 200
+# Highlighted CREATE TABLE statements kept per table and schema version
+DDL_CACHE_SIZE = 256
+# Pages answer If-None-Match with 304 while the schema version and the table's
+# pg_stat_user_tables counters are unchanged
+CONDITIONAL_GET = True
+# Text responses of at least COMPRESS_MIN_SIZE bytes are sent with brotli (if
+# installed) or gzip, whichever the browser prefers
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+COMPRESS_MIMETYPES = ('text/html', 'text/plain', 'text/css', 'text/csv', 'application/json',
+                      'application/javascript')
+# Static URLs carry the file's modification time, so browsers may keep them for a year
+STATIC_MAX_AGE = 365 * 24 * 3600
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 10
+POOL_TIMEOUT = 30
+POOL_IDLE_TIMEOUT = 300
+POOL_HEALTH_CHECK_INTERVAL = 30
+# Every browser session has its own pool of up to POOL_MAX_SIZE connections. All
+# sessions together open at most MAX_CONNECTIONS (0: no limit), at most
+# MAX_SESSIONS are kept, and sessions unused for SESSION_IDLE_TIMEOUT seconds are closed
+MAX_CONNECTIONS = 50
+MAX_SESSIONS = 20
+SESSION_IDLE_TIMEOUT = 1800
+# Read-only pages, table exports and console statements that look read-only are
+# served by a streaming replica: REPLICAS maps a primary's 'host:port' to its
+# replica's. The primary is used instead while the replica lags more than
+# REPLICA_MAX_LAG seconds (checked at most every REPLICA_LAG_CHECK_INTERVAL
+# seconds), and for REPLICA_STICKY_SECONDS after the session writes
+REPLICAS = {}
+REPLICA_MAX_LAG = 10
+REPLICA_LAG_CHECK_INTERVAL = 5
+REPLICA_STICKY_SECONDS = 15
+# Signs the session cookie; set it to keep sessions valid across restarts
+SECRET_KEY = os.environ.get('SECRET_KEY') or os.urandom(24)
+# Set to a channel name to get external DDL pushed by the event trigger
+# installed with `flask --app main install-schema-trigger`
+SCHEMA_NOTIFY_CHANNEL = None
+# Background console jobs: JOB_WORKERS queries run at once, each keeps at most
+# JOB_MAX_ROWS rows for JOB_RESULT_TTL seconds, and JOB_HISTORY_SIZE jobs are kept
+JOB_WORKERS = 4
+JOB_TIMEOUT = 0
+JOB_MAX_ROWS = 100000
+JOB_RESULT_TTL = 600
+JOB_HISTORY_SIZE = 50
+# Profiled plans saved for comparison; up to PLAN_HOT_NODES nodes taking at
+# least PLAN_HOT_SHARE of the runtime are highlighted. Each database sees only
+# its own plans, and only the owner can read the files
+PLAN_DIRECTORY = os.path.join(tempfile.gettempdir(), 'pgweb-plans')
+PLAN_HOT_NODES = 3
+PLAN_HOT_SHARE = 0.1
+# Every statement is timed; DEBUG_FOOTER lists a page's statements under it and
+# marks fingerprints run at least N_PLUS_ONE_THRESHOLD times
+DEBUG_FOOTER = False
+N_PLUS_ONE_THRESHOLD = 5
+# Console statements and writes made by the app are logged to this SQLite file
+# (None turns the log off), which keeps the latest HISTORY_SIZE entries with at
+# most HISTORY_SQL_LIMIT characters of each statement. Only its owner can read it
+HISTORY_DATABASE = os.path.join(tempfile.gettempdir(), 'pgweb-history.sqlite3')
+HISTORY_SIZE = 10000
+HISTORY_SQL_LIMIT = 10000
+HISTORY_PAGE_SIZE = 100
+HISTORY_TOP = 20
+
+
+class App(Flask):
+
+    def get_send_file_max_age(self, filename):
+        # Other files sent, like rejected import rows, hold table data
+        if has_request_context() and request.endpoint == 'static':
+            return self.config['STATIC_MAX_AGE']
+        return super().get_send_file_max_age(filename)
+
+
+app = App(__name__)
 app.config.from_object(__name__)
 
-dataset = None
+RowCount = namedtuple('RowCount', ['count', 'estimated'])
+Page = namedtuple('Page', ['rows', 'next_cursor', 'previous_cursor'])
+Column = namedtuple('Column', ['name', 'data_type', 'nullable', 'default', 'primary_key', 'full_type'])
+ForeignKey = namedtuple('ForeignKey', ['name', 'columns', 'foreign_table', 'foreign_columns'])
+Index = namedtuple('Index', ['name', 'columns', 'unique', 'primary', 'definition'])
+TableSchema = namedtuple('TableSchema', ['name', 'owner', 'columns', 'primary_key', 'foreign_keys', 'indexes'])
+QueryResult = namedtuple('QueryResult', ['description', 'rows', 'row_count', 'has_more'])
+PlanNode = namedtuple('PlanNode', ['depth', 'label', 'estimated_rows', 'actual_rows', 'loops', 'total', 'exclusive',
+                                   'share', 'shared_hit', 'shared_read', 'misestimate', 'hot'])
+ColumnProfile = namedtuple('ColumnProfile', ['name', 'data_type', 'null_frac', 'distinct', 'avg_width', 'correlation',
+                                             'most_common', 'histogram'])
+IndexStats = namedtuple('IndexStats', ['name', 'columns', 'unique', 'primary', 'valid', 'method', 'definition',
+                                       'size', 'scans', 'tuples_read', 'constraint', 'unused', 'redundant_to'])
+Predicate = namedtuple('Predicate', ['columns', 'kind', 'condition', 'params'])
+QueryRecord = namedtuple('QueryRecord', ['fingerprint', 'sql', 'duration', 'rows', 'error'])
+HistoryEntry = namedtuple('HistoryEntry', ['id', 'started', 'source', 'fingerprint', 'sql', 'duration', 'rows', 'error'])
+StatementStats = namedtuple('StatementStats', ['fingerprint', 'sql', 'calls', 'total', 'mean', 'max', 'errors', 'last',
+                                               'server'])
+ServerStatement = namedtuple('ServerStatement', ['fingerprint', 'query', 'calls', 'total', 'mean', 'rows'])
+Profile = namedtuple('Profile', ['nodes', 'analyzed', 'planning_time', 'execution_time', 'total', 'shared_hit',
+                                 'shared_read', 'plan'])
+
+read_query_re = re.compile(r'^\s*(?:--[^\n]*\n\s*|/\*.*?\*/\s*)*(select|with|values|table)\b', re.I | re.S)
+# Comments, string literals, quoted identifiers and dollar-quoted bodies
+sql_literal_re = re.compile(
+    r"--[^\n]*|/\*.*?\*/|[Ee]'(?:[^'\\]|\\.|'')*'|[BbXxNnUu]?&?'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\""
+    r"|(\$[A-Za-z_]\w*\$|\$\$).*?\1", re.S)
+# SELECT ... INTO and data-modifying WITH queries write, and can't be declared as cursors
+write_clause_re = re.compile(r'\binto\b|\bdelete\s+from\b|\bupdate\s+\S+(?:\s+(?:as\s+)?\S+)?\s+set\b', re.I)
+# Statements the app issues on its own that change data or schema; COPY only when loading
+write_query_re = re.compile(
+    r'^\s*(insert|update|delete|merge|truncate|alter|create|drop|comment|grant|revoke|analyze|vacuum'
+    r'|copy\s+[^(].*\bfrom\b)', re.I | re.S)
+
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv', "WITH (FORMAT csv, HEADER)"),
+    # jsonb output escapes control characters inside strings and never adds
+    # whitespace newlines, so CSV with these quote and delimiter bytes passes
+    # every JSON document through unchanged, one per line
+    'jsonl': ('application/x-ndjson', 'jsonl', "WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')"),
+    'binary': ('application/octet-stream', 'bin', "WITH (FORMAT binary)"),
+}
+
+
+def copy_to_sql(query, fmt):
+    if fmt == 'jsonl':
+        # row_to_json would keep json columns verbatim, including raw newlines
+        query = pg_sql.SQL('SELECT to_jsonb(q)::text FROM ({}) q').format(query)
+    return pg_sql.SQL('COPY ({}) TO STDOUT {}').format(query, pg_sql.SQL(EXPORT_FORMATS[fmt][2]))
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class QueueWriter():
+    # File-like target for copy_expert() that hands fixed-size chunks to a bounded queue
+
+    def __init__(self, chunks, cancelled, chunk_size=EXPORT_CHUNK_SIZE):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.chunk_size = chunk_size
+        self._buffer = bytearray()
+
+    def put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise IOError('export cancelled')
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.put(bytes(self._buffer))
+            self._buffer = bytearray()
+
+
+def is_read_query(sql):
+    # Single SELECT-like statements can run through a server-side cursor
+    body = sql_literal_re.sub(' ', sql).strip().rstrip(';')
+    return bool(read_query_re.match(body)) and ';' not in body and not write_clause_re.search(body)
+
+
+def plan_label(node):
+    label = node['Node Type']
+    if node.get('Strategy') not in (None, 'Plain'):
+        label = f"{node['Strategy']} {label}"
+    if node.get('Join Type') not in (None, 'Inner'):
+        label += f" {node['Join Type']}"
+    if node.get('Index Name'):
+        label += f" using {node['Index Name']}"
+    if node.get('Relation Name'):
+        label += f" on {node['Relation Name']}"
+        if node.get('Alias') not in (None, node['Relation Name']):
+            label += f" {node['Alias']}"
+    if node.get('Subplan Name'):
+        label = f"{node['Subplan Name']}: {label}"
+    return label
+
+
+def profile_plan(plan, hot_nodes=PLAN_HOT_NODES, hot_share=PLAN_HOT_SHARE):
+    # Flattens EXPLAIN (FORMAT JSON) output into tree order. Times, costs and
+    # buffers of a node include its children, so exclusive values subtract them
+    root = plan['Plan']
+    analyzed = 'Actual Total Time' in root
+
+    def cost(node):
+        if analyzed:
+            # Actual times are per loop
+            return node.get('Actual Total Time', 0) * node.get('Actual Loops', 1)
+        return node['Total Cost']
+
+    flat = []
+
+    def walk(node, depth):
+        children = node.get('Plans', [])
+        total = cost(node)
+        exclusive = max(total - sum(cost(child) for child in children), 0)
+        hit = node.get('Shared Hit Blocks', 0) - sum(child.get('Shared Hit Blocks', 0) for child in children)
+        read = node.get('Shared Read Blocks', 0) - sum(child.get('Shared Read Blocks', 0) for child in children)
+        actual = None
+        if analyzed:
+            actual = node.get('Actual Rows', 0) * node.get('Actual Loops', 1)
+        estimated = node['Plan Rows'] * (node.get('Actual Loops', 1) if analyzed else 1)
+        misestimate = None
+        if actual is not None:
+            misestimate = max(actual, 1) / max(estimated, 1)
+        flat.append([depth, plan_label(node), estimated, actual, node.get('Actual Loops'), total, exclusive,
+                     max(hit, 0), max(read, 0), misestimate])
+        for child in children:
+            walk(child, depth + 1)
+
+    walk(root, 0)
+    grand_total = cost(root) or 1
+    ranked = sorted(range(len(flat)), key=lambda i: flat[i][6], reverse=True)
+    hot = {i for i in ranked[:hot_nodes] if flat[i][6] / grand_total >= hot_share}
+    nodes = [PlanNode(depth, label, estimated, actual, loops, total, exclusive, exclusive / grand_total,
+                      hit, read, misestimate, i in hot)
+             for i, (depth, label, estimated, actual, loops, total, exclusive, hit, read, misestimate)
+             in enumerate(flat)]
+    return Profile(nodes, analyzed, plan.get('Planning Time'), plan.get('Execution Time'), cost(root),
+                   root.get('Shared Hit Blocks'), root.get('Shared Read Blocks'), plan)
+
+
+def plan_outline(profile):
+    # Timing-free text of a plan, so that a diff shows changes of shape and estimates
+    return [f"{'  ' * node.depth}-> {node.label} (rows={node.estimated_rows:.0f})" for node in profile.nodes]
+
+
+def plan_path(directory, plan_id):
+    if not re.fullmatch(r'[0-9a-f]{32}', plan_id or ''):
+        return None
+    return os.path.join(directory, f'{plan_id}.json')
+
+
+def save_plan(directory, location, table, sql, name, plan):
+    # Plans hold statements and their data, so only this user may read them
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    os.chmod(directory, 0o700)
+    saved = {'id': uuid.uuid4().hex, 'location': location, 'table': table, 'sql': sql, 'name': name or sql[:60],
+             'saved': time.time(), 'plan': plan}
+    fd = os.open(plan_path(directory, saved['id']), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as file:
+        json.dump(saved, file)
+    return saved
+
+
+def load_plan(directory, location, plan_id):
+    # Only plans saved for the same database
+    path = plan_path(directory, plan_id)
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as file:
+        saved = json.load(file)
+    return saved if saved.get('location') == location else None
+
+
+def list_plans(directory, location, table=None):
+    if not os.path.isdir(directory):
+        return []
+    plans = []
+    for filename in os.listdir(directory):
+        saved = load_plan(directory, location, filename[:-len('.json')]) if filename.endswith('.json') else None
+        if saved is not None and (table is None or saved['table'] == table):
+            plans.append(saved)
+    return sorted(plans, key=lambda saved: saved['saved'], reverse=True)
+
+
+def compare_plans(before, after):
+    deltas = []
+    for label, field in [('Planning time, ms', 'planning_time'), ('Execution time, ms', 'execution_time'),
+                         ('Total', 'total'), ('Shared hit blocks', 'shared_hit'),
+                         ('Shared read blocks', 'shared_read')]:
+        old, new = getattr(before, field), getattr(after, field)
+        change = None
+        if old is not None and new is not None:
+            change = new - old
+        deltas.append((label, old, new, change))
+    diff = list(difflib.unified_diff(plan_outline(before), plan_outline(after), 'before', 'after', lineterm=''))
+    return deltas, diff
+
+
+# Columns, primary/foreign keys and indexes of every relation in one round trip
+SCHEMA_SQL = '''
+SELECT c.relname, pg_get_userbyid(c.relowner),
+  (SELECT json_agg(json_build_array(a.attname, format_type(a.atttypid, NULL), NOT a.attnotnull,
+                                    pg_get_expr(d.adbin, d.adrelid), format_type(a.atttypid, a.atttypmod))
+                   ORDER BY a.attnum)
+   FROM pg_attribute a
+   LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+   WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped),
+  (SELECT json_agg(json_build_array(
+            co.conname, co.contype,
+            (SELECT json_agg(a.attname ORDER BY k.n) FROM unnest(co.conkey) WITH ORDINALITY k(attnum, n)
+             JOIN pg_attribute a ON a.attrelid = co.conrelid AND a.attnum = k.attnum),
+            fc.relname,
+            (SELECT json_agg(a.attname ORDER BY k.n) FROM unnest(co.confkey) WITH ORDINALITY k(attnum, n)
+             JOIN pg_attribute a ON a.attrelid = co.confrelid AND a.attnum = k.attnum))
+          ORDER BY co.conname)
+   FROM pg_constraint co
+   LEFT JOIN pg_class fc ON fc.oid = co.confrelid
+   WHERE co.conrelid = c.oid AND co.contype IN ('p', 'f')),
+  (SELECT json_agg(json_build_array(
+            ic.relname,
+            (SELECT json_agg(pg_get_indexdef(i.indexrelid, k, true) ORDER BY k)
+             FROM generate_series(1, i.indnatts) k),
+            i.indisunique, i.indisprimary, pg_get_indexdef(i.indexrelid))
+          ORDER BY ic.relname)
+   FROM pg_index i
+   JOIN pg_class ic ON ic.oid = i.indexrelid
+   WHERE i.indrelid = c.oid)
+FROM pg_class c
+WHERE c.relnamespace = 'public'::regnamespace AND c.relkind IN ('r', 'p', 'v', 'm', 'f')'''
+
+
+def parse_flag(value):
+    # type=bool would take any non-empty value, "0" included, as true
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def parse_order(order):
+    if not order:
+        return None, False
+    return order.lstrip('-'), order.startswith('-')
+
+
+def encode_cursor(values):
+    data = json.dumps([None if value is None else str(value) for value in values])
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def seek_condition(keys, values):
+    # "Comes after the cursor" for ORDER BY keys, following PostgreSQL's default
+    # NULLS LAST for ascending and NULLS FIRST for descending order.
+    names = [pg_sql.Identifier(name) for name, _, _ in keys]
+    descending = keys[0][1]
+    if not any(nullable for _, _, nullable in keys) and None not in values:
+        condition = pg_sql.SQL('({}) %s ({})' % ('<' if descending else '>')).format(
+            pg_sql.SQL(', ').join(names),
+            pg_sql.SQL(', ').join(pg_sql.Placeholder() * len(values)))
+        return condition, list(values)
+
+    branches, params = [], []
+    for i, (name, value) in enumerate(zip(names, values)):
+        parts, branch_params = [], []
+        for previous, previous_value in zip(names[:i], values[:i]):
+            if previous_value is None:
+                parts.append(pg_sql.SQL('{} IS NULL').format(previous))
+            else:
+                parts.append(pg_sql.SQL('{} = %s').format(previous))
+                branch_params.append(previous_value)
+        if value is None:
+            if not descending:
+                continue
+            parts.append(pg_sql.SQL('{} IS NOT NULL').format(name))
+        elif descending:
+            parts.append(pg_sql.SQL('{} < %s').format(name))
+            branch_params.append(value)
+        else:
+            parts.append(pg_sql.SQL('({0} > %s OR {0} IS NULL)').format(name))
+            branch_params.append(value)
+        branches.append(pg_sql.SQL('({})').format(pg_sql.SQL(' AND ').join(parts)))
+        params += branch_params
+    if not branches:
+        return pg_sql.SQL('FALSE'), []
+    return pg_sql.SQL('({})').format(pg_sql.SQL(' OR ').join(branches)), params
+
+
+TEXT_TYPES = ('text', 'character varying', 'character', 'citext', 'name')
+filter_operator_re = re.compile(r'^(>=|<=|!=|<>|=|>|<)\s*(.*)$', re.S)
+
+
+def like_pattern(text):
+    return '%' + re.sub(r'([\\%_])', r'\\\1', text) + '%'
+
+
+def parse_filter(column, expression):
+    # Grid filter syntax: "null", "!null", "=x", "!=x", ">x", ">=x", "<x", "<=x",
+    # "a..b"; anything else is a substring on text columns and equality otherwise
+    text = expression.strip()
+    name = pg_sql.Identifier(column.name)
+    value = pg_sql.SQL('%s::{}').format(pg_sql.SQL(column.full_type))
+    if text.lower() in ('null', 'is null'):
+        return Predicate([column.name], 'null', pg_sql.SQL('{} IS NULL').format(name), [])
+    if text.lower() in ('!null', 'not null', 'is not null'):
+        return Predicate([column.name], 'null', pg_sql.SQL('{} IS NOT NULL').format(name), [])
+    match = filter_operator_re.match(text)
+    if match:
+        operator = '<>' if match.group(1) == '!=' else match.group(1)
+        kind = 'equality' if operator == '=' else 'range'
+        return Predicate([column.name], kind, pg_sql.SQL('{} {} {}').format(name, pg_sql.SQL(operator), value),
+                         [match.group(2)])
+    if '..' in text:
+        low, high = [part.strip() for part in text.split('..', 1)]
+        conditions, params = [], []
+        if low:
+            conditions.append(pg_sql.SQL('{} >= {}').format(name, value))
+            params.append(low)
+        if high:
+            conditions.append(pg_sql.SQL('{} <= {}').format(name, value))
+            params.append(high)
+        if conditions:
+            return Predicate([column.name], 'range', pg_sql.SQL(' AND ').join(conditions), params)
+    if column.data_type in TEXT_TYPES:
+        return Predicate([column.name], 'substring', pg_sql.SQL('{} ILIKE %s').format(name), [like_pattern(text)])
+    return Predicate([column.name], 'equality', pg_sql.SQL('{} = {}').format(name, value), [text])
+
+
+def search_predicate(columns, text):
+    names = [column.name for column in columns if column.data_type in TEXT_TYPES]
+    if not names:
+        return None
+    condition = pg_sql.SQL('({})').format(pg_sql.SQL(' OR ').join(
+        pg_sql.SQL('{} ILIKE %s').format(pg_sql.Identifier(name)) for name in names))
+    return Predicate(names, 'substring', condition, [like_pattern(text.strip())] * len(names))
+
+
+def combine_predicates(predicates):
+    if not predicates:
+        return None
+    return (pg_sql.SQL(' AND ').join(predicate.condition for predicate in predicates),
+            [param for predicate in predicates for param in predicate.params])
+
+
+def index_hints(table, predicates, indexes):
+    # Suggest an index for predicates that nothing on the table can serve
+    hints = []
+    for predicate in predicates:
+        for column in predicate.columns:
+            if predicate.kind == 'substring':
+                if any(column in index.columns and re.search(r'\bgi(n|st)_trgm_ops\b', index.definition)
+                       for index in indexes):
+                    continue
+                hints.append((column, 'Substring search scans the whole table without a trigram index',
+                              f'CREATE EXTENSION IF NOT EXISTS pg_trgm;\n'
+                              f'CREATE INDEX CONCURRENTLY ON "{table}" USING gin ("{column}" gin_trgm_ops);',
+                              {'indexed_columns': column, 'method': 'gin', 'opclass': 'gin_trgm_ops'}))
+            elif not any(index.columns[:1] == [column] and 'USING btree' in index.definition for index in indexes):
+                hints.append((column, 'No index starts with this column',
+                              f'CREATE INDEX CONCURRENTLY ON "{table}" ("{column}");',
+                              {'indexed_columns': column}))
+    return hints
+
+
+fingerprint_res = [
+    (re.compile(r'--[^\n]*|/\*.*?\*/', re.S), ' '),
+    (re.compile(r"[EeBbXxNn]?'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\$\d+|\b\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b'), '?'),
+    (re.compile(r'\b(?:true|false|null)\b', re.I), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), '(...)'),
+    (re.compile(r'(\((?:\.\.\.|\?)\))(?:\s*,\s*\((?:\.\.\.|\?)\))+'), r'\1, ...'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def fingerprint(sql):
+    # Statement text with literals and value lists replaced, to group repeats
+    for pattern, replacement in fingerprint_res:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+class Histogram():
+
+    def __init__(self, name, documentation, labels, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> ([count per bucket], sum, count)
+        self.series = {}
+
+    def observe(self, values, value):
+        counts, total, count = self.series.get(values) or ([0] * len(self.buckets), 0, 0)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.series[values] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for values, (counts, total, count) in sorted(self.series.items()):
+            labels = ','.join(f'{name}="{value}"' for name, value in zip(self.labels, values))
+            prefix = labels + ',' if labels else ''
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {bucket_count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return lines
+
+
+class Metrics():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.request_latency = Histogram(
+            'pgweb_request_duration_seconds', 'Request latency by route.', ('route', 'method'),
+            (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+        self.request_queries = Histogram(
+            'pgweb_request_queries', 'SQL statements run per request by route.', ('route', 'method'),
+            (0, 1, 2, 5, 10, 20, 50, 100))
+        self.query_latency = Histogram(
+            'pgweb_query_duration_seconds', 'SQL statement latency.', (),
+            (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+        self.query_errors = 0
+
+    def observe_query(self, record):
+        with self.lock:
+            self.query_latency.observe((), record.duration)
+            if record.error:
+                self.query_errors += 1
+
+    def observe_request(self, route, method, duration, queries):
+        with self.lock:
+            self.request_latency.observe((route, method), duration)
+            self.request_queries.observe((route, method), queries)
+
+    def render(self, pool_stats=None):
+        with self.lock:
+            lines = self.request_latency.render() + self.request_queries.render() + self.query_latency.render()
+            lines += ['# HELP pgweb_query_errors_total SQL statements that failed.',
+                      '# TYPE pgweb_query_errors_total counter',
+                      f'pgweb_query_errors_total {self.query_errors}']
+        if pool_stats:
+            for key, documentation in [('size', 'Open connections.'), ('in_use', 'Checked out connections.'),
+                                       ('idle', 'Idle connections.'), ('max', 'Connection limit.')]:
+                lines += [f'# HELP pgweb_pool_{key} {documentation}', f'# TYPE pgweb_pool_{key} gauge',
+                          f'pgweb_pool_{key} {pool_stats[key]}']
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def record_query(record):
+    metrics.observe_query(record)
+    if has_request_context() and 'queries' in g:
+        g.queries.append(record)
+
+
+class InstrumentedConnection(extensions.connection):
+    # The owning PostgresTools' location, which keys the query history
+    location = None
+
+
+class InstrumentedCursor(extensions.cursor):
+    # Times every statement sent through PostgresTools connections
+    # Console statements are logged to the history by their callers, fetches included
+    log_history = True
+
+    def _timed(self, method, sql, *args):
+        previous = self.query
+        started = time.perf_counter()
+        error = None
+        try:
+            return method(sql, *args)
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            # query is the statement as sent, unless it never got that far
+            if self.query is not None and self.query is not previous:
+                text = self.query.decode('utf-8', 'replace')
+            else:
+                text = sql if isinstance(sql, str) else sql.as_string(self.connection)
+            rows = self.rowcount if error is None and self.rowcount >= 0 else None
+            record_query(QueryRecord(fingerprint(text), text, duration, rows, error))
+            location = getattr(self.connection, 'location', None)
+            if self.log_history and location is not None and write_query_re.match(text):
+                query_history.add(location, 'app', text, duration, rows, error)
+
+    def _fetched(self, method, *args):
+        # Every fetch from a server-side cursor is another round trip
+        if self.name is None:
+            return method(*args)
+        started = time.perf_counter()
+        rows = method(*args)
+        record_query(QueryRecord('FETCH FROM cursor', f'FETCH FROM {self.name}', time.perf_counter() - started,
+                                 len(rows) if isinstance(rows, list) else int(rows is not None), None))
+        return rows
+
+    def execute(self, sql, vars=None):
+        return self._timed(super().execute, sql, vars)
+
+    def executemany(self, sql, vars_list):
+        return self._timed(super().executemany, sql, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(super().copy_expert, sql, file, size)
+
+    def fetchone(self):
+        return self._fetched(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetched(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._fetched(super().fetchall)
+
+    def __iter__(self):
+        # Iterating a server-side cursor fetches itersize rows per round trip
+        # behind fetch*, so go through fetchmany to time each of them
+        if self.name is None:
+            return super().__iter__()
+        return self._iterate()
+
+    def _iterate(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+
+class QueryHistory():
+    # One SQLite connection shared by all threads, opened on first use
+
+    def __init__(self):
+        self._conn = None
+        self._lock = threading.Lock()
+        self._inserts = 0
+
+    def _connect(self):
+        if self._conn is None and app.config['HISTORY_DATABASE']:
+            # Statements carry data, so only this user may read them; SQLite gives
+            # the -wal and -shm files the same mode
+            path = app.config['HISTORY_DATABASE']
+            os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+            os.chmod(path, 0o600)
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY, started REAL, '
+                         'database TEXT, source TEXT, fingerprint TEXT, sql TEXT, duration REAL, '
+                         'rows INTEGER, error TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS history_fingerprint ON history (database, fingerprint)')
+            self._conn = conn
+        return self._conn
+
+    def add(self, database, source, sql, duration, rows=None, error=None):
+        try:
+            with self._lock:
+                conn = self._connect()
+                if conn is None:
+                    return
+                with conn:
+                    conn.execute(
+                        'INSERT INTO history (started, database, source, fingerprint, sql, duration, rows, error) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (time.time() - duration, database, source, fingerprint(sql),
+                         sql[:app.config['HISTORY_SQL_LIMIT']], duration, rows, error))
+                    # Trimming on every insert would cost more than the insert
+                    if self._inserts % 100 == 0:
+                        conn.execute('DELETE FROM history WHERE id <= (SELECT max(id) FROM history) - ?',
+                                     (app.config['HISTORY_SIZE'],))
+                    self._inserts += 1
+        except (sqlite3.Error, OSError) as e:
+            print(f"Error writing the query history: {e}")
+
+    def _select(self, sql, params):
+        try:
+            with self._lock:
+                conn = self._connect()
+                return conn.execute(sql, params).fetchall() if conn is not None else []
+        except (sqlite3.Error, OSError) as e:
+            print(f"Error reading the query history: {e}")
+            return []
+
+    def recent(self, database, limit, selected=None):
+        condition = ' AND fingerprint = ?' if selected is not None else ''
+        rows = self._select(
+            f'SELECT id, started, source, fingerprint, sql, duration, rows, error FROM history '
+            f'WHERE database = ?{condition} ORDER BY id DESC LIMIT ?',
+            [database] + ([selected] if selected is not None else []) + [limit])
+        return [HistoryEntry(*row) for row in rows]
+
+    def top(self, database, order, limit):
+        # order: 'slowest' by mean duration, 'frequent' by number of runs
+        rows = self._select(
+            f'SELECT fingerprint, (SELECT sql FROM history latest WHERE latest.database = h.database '
+            f'AND latest.fingerprint = h.fingerprint ORDER BY id DESC LIMIT 1), count(*), sum(duration), '
+            f'avg(duration), max(duration), count(error), max(started) FROM history h WHERE database = ? '
+            f'GROUP BY fingerprint ORDER BY {"avg(duration)" if order == "slowest" else "count(*)"} DESC LIMIT ?',
+            (database, limit))
+        return [StatementStats(*row, server=None) for row in rows]
+
+
+query_history = QueryHistory()
+
+
+def merge_statement_stats(statements, server, order, limit):
+    # pg_stat_statements writes parameters as $n, which fingerprint the same as literals
+    by_fingerprint = {}
+    for statement in server:
+        by_fingerprint.setdefault(statement.fingerprint, statement)
+    merged = [statement._replace(server=by_fingerprint.pop(statement.fingerprint, None))
+              for statement in statements]
+    unmatched = sorted(by_fingerprint.values(), reverse=True,
+                       key=lambda statement: statement.mean if order == 'slowest' else statement.calls)
+    return merged, unmatched[:limit]
+
+
+class LRUCache():
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        # Two threads may both load a missing value; either result is fine
+        value = loader()
+        with self._lock:
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class ConnectionLimit():
+    # Connections open across several pools; reclaim() may close idle ones to make room
+
+    def __init__(self, limit=0, reclaim=None):
+        self.limit = limit
+        self.reclaim = reclaim
+        self.open = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, deadline):
+        reclaimed = False
+        while True:
+            with self._condition:
+                if not self.limit or self.open < self.limit:
+                    self.open += 1
+                    return
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolError('all %s connections are in use' % self.limit)
+                if reclaimed:
+                    self._condition.wait(remaining)
+            # Outside the lock: reclaiming takes pool locks, which release() is called under
+            if not reclaimed and self.reclaim is not None:
+                self.reclaim()
+            reclaimed = True
+
+    def release(self):
+        with self._condition:
+            self.open -= 1
+            self._condition.notify()
+
+
+class ConnectionPool():
+
+    def __init__(self, minconn=POOL_MIN_SIZE, maxconn=POOL_MAX_SIZE, timeout=POOL_TIMEOUT,
+                 idle_timeout=POOL_IDLE_TIMEOUT, health_check_interval=POOL_HEALTH_CHECK_INTERVAL,
+                 limit=None, location=None, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = max(maxconn, minconn, 1)
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        # Shared with other pools, counts every connection this one opens
+        self.limit = limit
+        self.location = location
+        self.closed = False
+        self._connect_kwargs = connect_kwargs
+        self._condition = threading.Condition()
+        # (connection, time it was returned), most recently used last
+        self._idle = []
+        self._in_use = set()
+        self._size = 0
+        for _ in range(minconn):
+            if self.limit is not None:
+                self.limit.acquire(time.time() + timeout)
+            self._size += 1
+            try:
+                self._idle.append((self._connect(), time.time()))
+            except Exception:
+                self._shrink()
+                raise
+
+    def _connect(self):
+        conn = psycopg2.connect(connection_factory=InstrumentedConnection, **self._connect_kwargs)
+        conn.location = self.location
+        return conn
+
+    def _shrink(self, count=1):
+        self._size -= count
+        if self.limit is not None:
+            for _ in range(count):
+                self.limit.release()
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _reap(self):
+        # Called with the lock held: close connections idle for too long, keeping minconn
+        now = time.time()
+        keep = []
+        for conn, last_used in self._idle:
+            if self._size > self.minconn and now - last_used > self.idle_timeout:
+                self._discard(conn)
+                self._shrink()
+            else:
+                keep.append((conn, last_used))
+        self._idle = keep
+
+    def getconn(self):
+        deadline = time.time() + self.timeout
+        with self._condition:
+            while True:
+                if self.closed:
+                    raise PoolError('connection pool is closed')
+                self._reap()
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    conn, last_used = None, None
+                    self._size += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolError('no connection available within %s seconds' % self.timeout)
+                self._condition.wait(remaining)
+
+        if conn is None and self.limit is not None:
+            try:
+                self.limit.acquire(deadline)
+            except PoolError:
+                with self._condition:
+                    self._size -= 1
+                    self._condition.notify()
+                raise
+        try:
+            if conn is not None and time.time() - last_used > self.health_check_interval \
+                    and not self._is_healthy(conn):
+                self._discard(conn)
+                conn = None
+            if conn is None or conn.closed:
+                conn = self._connect()
+        except Exception:
+            with self._condition:
+                self._shrink()
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self._in_use.add(conn)
+        return conn
+
+    def putconn(self, conn, close=False):
+        if not conn.closed and not close:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+        with self._condition:
+            self._in_use.discard(conn)
+            if conn.closed or close or self.closed:
+                self._discard(conn)
+                self._shrink()
+            else:
+                self._idle.append((conn, time.time()))
+            self._reap()
+            self._condition.notify()
+
+    def closeall(self):
+        with self._condition:
+            self.closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._shrink(len(self._idle))
+            self._idle = []
+            self._condition.notify_all()
+
+    def close_idle(self):
+        # Frees connections for other pools sharing the limit, minconn included
+        with self._condition:
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._shrink(len(self._idle))
+            self._idle = []
+
+    def stats(self):
+        with self._condition:
+            return {'size': self._size, 'idle': len(self._idle),
+                    'in_use': len(self._in_use), 'max': self.maxconn}
+
+
+class SchemaListener(threading.Thread):
+    # One LISTEN connection per database, shared by every session on it and
+    # counted against the connection limit
+
+    def __init__(self, channel, limit=None, **connect_kwargs):
+        super().__init__(name='schema-listener', daemon=True)
+        self.channel = channel
+        self.limit = limit
+        self.alive = False
+        # on_change callbacks of the sessions listening
+        self.subscribers = set()
+        self._connect_kwargs = connect_kwargs
+        self._stopped = threading.Event()
+
+    def on_change(self):
+        for on_change in list(self.subscribers):
+            on_change()
+
+    def run(self):
+        while not self._stopped.is_set():
+            conn = None
+            acquired = False
+            try:
+                if self.limit is not None:
+                    self.limit.acquire(time.time() + app.config['POOL_TIMEOUT'])
+                    acquired = True
+                conn = psycopg2.connect(**self._connect_kwargs)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(pg_sql.SQL('LISTEN {}').format(pg_sql.Identifier(self.channel)))
+                self.alive = True
+                # Anything may have changed while we were not listening
+                self.on_change()
+                while not self._stopped.is_set():
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        self.on_change()
+            except (psycopg2.Error, PoolError) as e:
+                print(f"Error listening for schema changes: {e}")
+            finally:
+                self.alive = False
+                if conn is not None:
+                    conn.close()
+                if acquired:
+                    self.limit.release()
+            self._stopped.wait(5)
+
+    def stop(self):
+        self._stopped.set()
+
+
+schema_listeners = {}
+schema_listeners_lock = threading.Lock()
+
+
+def listen_for_schema_changes(location, channel, on_change, limit=None, **connect_kwargs):
+    with schema_listeners_lock:
+        listener = schema_listeners.get((location, channel))
+        if listener is None:
+            listener = schema_listeners[(location, channel)] = SchemaListener(channel, limit, **connect_kwargs)
+            listener.start()
+        listener.subscribers.add(on_change)
+        return listener
+
+
+def stop_listening(listener, on_change):
+    with schema_listeners_lock:
+        listener.subscribers.discard(on_change)
+        if not listener.subscribers:
+            listener.stop()
+            for key, value in list(schema_listeners.items()):
+                if value is listener:
+                    del schema_listeners[key]
+
 
 class PostgresTools():
 
-    def __init__(self, dbname, user, password, host='localhost', port=5432):
+    def __init__(self, dbname, user, password, host='localhost', port=5432,
+                 exact_count_threshold=EXACT_COUNT_THRESHOLD, row_count_ttl=ROW_COUNT_CACHE_TTL,
+                 pool_min_size=POOL_MIN_SIZE, pool_max_size=POOL_MAX_SIZE, pool_timeout=POOL_TIMEOUT,
+                 pool_idle_timeout=POOL_IDLE_TIMEOUT, pool_health_check_interval=POOL_HEALTH_CHECK_INTERVAL,
+                 schema_notify_channel=SCHEMA_NOTIFY_CHANNEL, connection_limit=None, replica=None,
+                 replica_max_lag=REPLICA_MAX_LAG, replica_lag_check_interval=REPLICA_LAG_CHECK_INTERVAL,
+                 replica_sticky_seconds=REPLICA_STICKY_SECONDS):
+        self.id = uuid.uuid4().hex
         self.dbname = dbname
         self.user = user
         self.password = password
         self.host = host
         self.port = port
-        self.db = psycopg2.connect(dbname=dbname, user=user, password=password, host=host, port=port)
-        self.cursor = self.db.cursor()
+        self.pool = ConnectionPool(
+            pool_min_size, pool_max_size, timeout=pool_timeout, idle_timeout=pool_idle_timeout,
+            health_check_interval=pool_health_check_interval, limit=connection_limit, location=self.location,
+            dbname=dbname, user=user, password=password, host=host, port=port,
+            cursor_factory=InstrumentedCursor)
+        # Fail on bad credentials right away, even with an empty pool
+        self.pool.putconn(self.pool.getconn())
+        # (host, port) of a streaming replica; its connections only ever run READ ONLY transactions
+        self.replica = None
+        self.replica_location = None
+        if replica is not None:
+            self.replica_location = f"PostgreSQL://{user}@{replica[0]}:{replica[1]}/{dbname}"
+            self.replica = ConnectionPool(
+                0, pool_max_size, timeout=pool_timeout, idle_timeout=pool_idle_timeout,
+                health_check_interval=pool_health_check_interval, limit=connection_limit, location=self.location,
+                dbname=dbname, user=user, password=password, host=replica[0], port=replica[1],
+                connect_timeout=5, options='-c default_transaction_read_only=on',
+                cursor_factory=InstrumentedCursor)
+        self.replica_max_lag = replica_max_lag
+        self.replica_lag_check_interval = replica_lag_check_interval
+        self.replica_sticky_seconds = replica_sticky_seconds
+        # (time checked, seconds behind or None when unusable)
+        self._replica_lag = (0, None)
+        self._written_at = 0
+        # Each thread (one request at a time) checks out its own connection
+        self._local = threading.local()
+        self.exact_count_threshold = exact_count_threshold
+        self.row_count_ttl = row_count_ttl
+        # table -> (RowCount, time it was taken)
+        self._row_counts = {}
+        # Table metadata, valid for the current schema_version only
+        self.schema_version = 0
+        # Bumped by every write made through the app, whose statistics may lag behind
+        self.data_version = 0
+        self._metadata = {}
+        self._metadata_lock = threading.Lock()
+        self._schema_fingerprint = None
+        self._listener = None
+        if schema_notify_channel:
+            self._listener = listen_for_schema_changes(
+                self.location, schema_notify_channel, self.invalidate_schema, connection_limit,
+                dbname=dbname, user=user, password=password, host=host, port=port)
+
+    @property
+    def db(self):
+        conn = getattr(self._local, 'db', None)
+        if conn is None or conn.closed:
+            self._local.pool, conn = self._getconn(getattr(self._local, 'read_only', False))
+            self._local.db = conn
+            self._local.cursor = None
+        return conn
 
+    @property
+    def cursor(self):
+        db = self.db
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None or cursor.closed:
+            cursor = self._local.cursor = db.cursor()
+        return cursor
+
+    def release(self):
+        self._local.schema_checked = False
+        self._local.read_only = False
+        conn = getattr(self._local, 'db', None)
+        if conn is not None:
+            self._local.db = None
+            self._local.cursor = None
+            self._local.pool.putconn(conn)
+
+    def read_from_replica(self):
+        # For the rest of the request, unless it already holds a connection
+        if getattr(self._local, 'db', None) is None:
+            self._local.read_only = True
+
+    @property
+    def on_replica(self):
+        return self.replica is not None and getattr(self._local, 'pool', None) is self.replica
+
+    def replica_lag(self):
+        checked, lag = self._replica_lag
+        if time.time() - checked < self.replica_lag_check_interval:
+            return lag
+        try:
+            conn = self.replica.getconn()
+            try:
+                with conn.cursor() as cursor:
+                    # Caught up replay means no lag, however old the last transaction is
+                    cursor.execute(
+                        "SELECT CASE WHEN NOT pg_is_in_recovery() "
+                        "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                        "ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END;")
+                    lag = cursor.fetchone()[0]
+            finally:
+                self.replica.putconn(conn)
+        except (psycopg2.Error, PoolError) as e:
+            print(f"Error checking the replica lag: {e}")
+            lag = None
+        lag = float(lag) if lag is not None else None
+        self._replica_lag = (time.time(), lag)
+        return lag
+
+    def _getconn(self, read=False):
+        # (pool, connection): the replica's for reads while it keeps up and the
+        # session has not written lately, the primary's otherwise
+        if (read and self.replica is not None
+                and time.time() - self._written_at >= self.replica_sticky_seconds):
+            lag = self.replica_lag()
+            if lag is not None and lag <= self.replica_max_lag:
+                try:
+                    return self.replica, self.replica.getconn()
+                except (psycopg2.Error, PoolError) as e:
+                    print(f"Error connecting to the replica: {e}")
+                    self._replica_lag = (time.time(), None)
+        return self.pool, self.pool.getconn()
+
+    @contextmanager
+    def connection(self, read=False):
+        pool, conn = self._getconn(read)
+        try:
+            yield conn
+        finally:
+            pool.putconn(conn)
+
+    @property
+    def pools(self):
+        return [self.pool] + ([self.replica] if self.replica is not None else [])
+
+    def close(self):
+        if self._listener is not None:
+            stop_listening(self._listener, self.invalidate_schema)
+        self.release()
+        for pool in self.pools:
+            pool.closeall()
+
+    def invalidate_schema(self):
+        with self._metadata_lock:
+            self.schema_version += 1
+            self._metadata = {}
+            self._schema_fingerprint = None
+        # Metadata reloaded from a replica that hasn't replayed the DDL yet would be cached as current
+        self.note_write()
+
+    def check_schema(self):
+        # At most once per request; the event trigger makes it free altogether
+        if getattr(self._local, 'schema_checked', False):
+            return
+        self._local.schema_checked = True
+        if self._listener is not None and self._listener.alive:
+            return
+        try:
+            self.cursor.execute(
+                "SELECT count(*), coalesce(sum(c.xmin::text::bigint), 0), "
+                "(SELECT coalesce(sum(a.xmin::text::bigint), 0) FROM pg_attribute a "
+                "WHERE a.attrelid IN (SELECT oid FROM pg_class WHERE relnamespace = 'public'::regnamespace)), "
+                "(SELECT coalesce(sum(co.xmin::text::bigint), 0) FROM pg_constraint co "
+                "WHERE co.connamespace = 'public'::regnamespace) "
+                "FROM pg_class c WHERE c.relnamespace = 'public'::regnamespace;"
+            )
+            fingerprint = self.cursor.fetchone()
+        except Exception as e:
+            print(f"Error checking the schema fingerprint: {e}")
+            self.db.rollback()
+            return
+        with self._metadata_lock:
+            if self._schema_fingerprint is not None and fingerprint != self._schema_fingerprint:
+                self.schema_version += 1
+                self._metadata = {}
+            self._schema_fingerprint = fingerprint
+
+    def _cached(self, key, loader):
+        self.check_schema()
+        version = self.schema_version
+        metadata = self._metadata
+        if key in metadata:
+            return metadata[key]
+        value = loader()
+        if value is not None:
+            with self._metadata_lock:
+                if version == self.schema_version:
+                    self._metadata[key] = value
+        return value
+
+    def install_schema_event_trigger(self, channel):
+        self.cursor.execute(pg_sql.SQL(
+            "CREATE OR REPLACE FUNCTION pgweb_notify_ddl() RETURNS event_trigger LANGUAGE plpgsql AS $$ "
+            "BEGIN PERFORM pg_notify({}, tg_tag); END $$; "
+            "DROP EVENT TRIGGER IF EXISTS pgweb_notify_ddl; "
+            "CREATE EVENT TRIGGER pgweb_notify_ddl ON ddl_command_end EXECUTE FUNCTION pgweb_notify_ddl();"
+        ).format(pg_sql.Literal(channel)))
+        self.db.commit()
 
     @property
     def filename(self):
         return self.dbname
 
+    @property
+    def busy(self):
+        # Requests, jobs, imports or index builds still hold connections
+        return any(pool.stats()['in_use'] for pool in self.pools)
+
     @property
     def location(self):
         return f"PostgreSQL://{self.user}@{self.host}:{self.port}/{self.dbname}"
@@ -48,8 +1322,12 @@ class PostgresTools():
 
     @property
     def tables(self):
+        return self._cached(('tables',), self._load_tables)
+
+    def _load_tables(self):
         self.cursor.execute(
-            "SELECT table_name FROM information_schema.tables WHERE table_schema='public' ORDER BY table_name;"
+            "SELECT relname FROM pg_class WHERE relnamespace = 'public'::regnamespace "
+            "AND relkind IN ('r', 'p', 'v', 'm', 'f') ORDER BY relname;"
         )
         result = self.cursor.fetchall()
         if result is not None:
@@ -57,126 +1335,682 @@ class PostgresTools():
         else:
             return set()
 
-    def get_table(self, table):
-        try:
-            self.cursor.execute('SELECT * FROM %s;' % table)
-            return self.cursor.fetchall()
-        except Exception as e:
-            print(f"Error updating the cell: {e}")
-            return None
-
-    def table_sql(self, table):
+    def estimate_row_count(self, table):
+        # Same extrapolation the planner does: tuples per page from the last
+        # ANALYZE multiplied by the current number of pages.
         try:
             self.cursor.execute(
-                "SELECT column_name, data_type, is_nullable FROM information_schema.columns WHERE table_name = %s;",
-                (table,)
-            )
-            columns_info = self.cursor.fetchall()
-
-            create_table_script = f"CREATE TABLE IF NOT EXISTS {table} (\n"
-            for column_info in columns_info:
-                column_name, data_type, is_nullable = column_info
-                create_table_script += f"    {column_name} {data_type}"
-                if is_nullable == 'NO':
-                    create_table_script += " NOT NULL"
-                create_table_script += ",\n"
-            create_table_script = create_table_script.rstrip(",\n") + "\n)"
-
-            # Fetch Primary Key constraint
-            self.cursor.execute(
-                "SELECT kcu.column_name FROM information_schema.table_constraints tc "
-                "JOIN information_schema.key_column_usage kcu "
-                "ON tc.constraint_name = kcu.constraint_name "
-                "WHERE tc.table_name = %s AND tc.constraint_type = 'PRIMARY KEY';",
+                "SELECT c.reltuples, c.relpages, "
+                "pg_relation_size(c.oid) / current_setting('block_size')::int, s.n_live_tup "
+                "FROM pg_class c LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid "
+                "WHERE c.relname = %s AND c.relnamespace = 'public'::regnamespace;",
                 (table,)
             )
-            primary_key_columns = [row[0] for row in self.cursor.fetchall()]
-
-            if primary_key_columns:
-                create_table_script += f",\nPRIMARY KEY ({', '.join(primary_key_columns)})"
+            row = self.cursor.fetchone()
+        except Exception as e:
+            print(f"Error estimating the row count: {e}")
+            self.db.rollback()
+            return None
+        if row is None:
+            return None
+        reltuples, relpages, pages, live_tuples = row
+        if reltuples >= 0 and relpages > 0:
+            return round(reltuples / relpages * pages)
+        if live_tuples is not None and (live_tuples > 0 or pages == 0):
+            return int(live_tuples)
+        return None
+
+    def exact_row_count(self, table):
+        try:
+            self.cursor.execute(pg_sql.SQL('SELECT count(*) FROM {};').format(pg_sql.Identifier(table)))
+            return self.cursor.fetchone()[0]
+        except Exception as e:
+            print(f"Error counting rows: {e}")
+            self.db.rollback()
+            return None
 
-            # Fetch Foreign Key constraints
+    def row_count(self, table, exact=False):
+        cached = self._row_counts.get(table)
+        if cached and time.time() - cached[1] < self.row_count_ttl:
+            if not exact or not cached[0].estimated:
+                return cached[0]
+
+        result = None
+        if not exact:
+            estimate = self.estimate_row_count(table)
+            if estimate is not None and estimate >= self.exact_count_threshold:
+                result = RowCount(estimate, True)
+        if result is None:
+            count = self.exact_row_count(table)
+            if count is None:
+                return RowCount(0, True)
+            result = RowCount(count, False)
+
+        self._row_counts[table] = (result, time.time())
+        return result
+
+    def filtered_row_count(self, table, where, exact=False):
+        # Returns the RowCount under a filter and whether the plan reads the whole table.
+        # Errors, like a value that doesn't fit the column type, are left to the caller
+        sql = pg_sql.SQL('SELECT * FROM {} WHERE ').format(pg_sql.Identifier(table)) + where[0]
+        try:
+            self.cursor.execute(pg_sql.SQL('EXPLAIN (FORMAT JSON) ') + sql, where[1])
+            plan = self.cursor.fetchone()[0][0]['Plan']
+            if exact:
+                self.cursor.execute(pg_sql.SQL('SELECT count(*) FROM ({}) AS filtered').format(sql), where[1])
+                count = RowCount(self.cursor.fetchone()[0], False)
+            else:
+                count = RowCount(round(plan['Plan Rows']), True)
+        except psycopg2.Error:
+            self.db.rollback()
+            raise
+
+        def seq_scan(node):
+            if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') == table:
+                return True
+            return any(seq_scan(child) for child in node.get('Plans', []))
+
+        return count, seq_scan(plan)
+
+    def column_profile(self, table):
+        # Everything comes from the planner statistics, so the cost doesn't grow with the table
+        self.cursor.execute("""
+            SELECT attname, null_frac, n_distinct, avg_width, correlation,
+                   most_common_vals::text::text[], most_common_freqs, histogram_bounds::text::text[]
+            FROM pg_stats WHERE schemaname = 'public' AND tablename = %s;""", (table,))
+        stats = {row[0]: row[1:] for row in self.cursor.fetchall()}
+        rows = self.row_count(table).count
+        profiles = []
+        for column in self.get_table_info(table):
+            if column.name not in stats:
+                profiles.append(ColumnProfile(column.name, column.full_type, None, None, None, None, [], []))
+                continue
+            null_frac, n_distinct, avg_width, correlation, values, freqs, histogram = stats[column.name]
+            # A negative n_distinct is a fraction of the row count, for columns that grow with the table
+            distinct = round(-n_distinct * rows) if n_distinct < 0 else round(n_distinct)
+            profiles.append(ColumnProfile(column.name, column.full_type, null_frac, distinct, avg_width, correlation,
+                                          list(zip(values or [], freqs or [])), histogram or []))
+        return profiles
+
+    def analyze(self, table, statistics_target=PROFILE_STATISTICS_TARGET):
+        self.cursor.execute('SET LOCAL default_statistics_target = %s', (int(statistics_target),))
+        self.cursor.execute(pg_sql.SQL('ANALYZE {}').format(pg_sql.Identifier(table)))
+        self.db.commit()
+        self.invalidate_row_count(table)
+
+    def preview(self, table, rows=PREVIEW_ROWS, seed=None):
+        # SYSTEM sampling picks whole pages, so ask for a few times the rows
+        # needed to make up for uneven pages, and LIMIT the rest away
+        estimate = self.estimate_row_count(table) or 0
+        percent = 100.0 if estimate <= rows else min(100.0, max(rows * 3 * 100.0 / estimate, 0.0001))
+        sql = pg_sql.SQL('SELECT * FROM {} TABLESAMPLE SYSTEM (%s){} LIMIT %s').format(
+            pg_sql.Identifier(table), pg_sql.SQL(' REPEATABLE (%s)' if seed is not None else ''))
+        params = [percent] + ([seed] if seed is not None else []) + [rows]
+        self.cursor.execute(sql, params)
+        return self.cursor.description, self.cursor.fetchall(), percent
+
+    def note_write(self):
+        with self._metadata_lock:
+            self.data_version += 1
+            # Read your own writes: the replica may not have them yet
+            self._written_at = time.time()
+
+    def table_fingerprint(self, table=None):
+        # What a page depends on: the schema, writes made here, and the table's
+        # modification counters (other clients' writes show up within seconds)
+        # (without a table, of the whole schema)
+        self.check_schema()
+        # A replica counts no replayed changes, so any replayed WAL counts as one
+        self.cursor.execute(
+            "SELECT sum(n_tup_ins), sum(n_tup_upd), sum(n_tup_del), "
+            "max(greatest(last_vacuum, last_autovacuum, last_analyze, last_autoanalyze)), "
+            "pg_last_wal_replay_lsn()::text "
+            "FROM pg_stat_user_tables WHERE schemaname = 'public' AND relname = coalesce(%s, relname);",
+            (table,))
+        return (self.schema_version, self.data_version) + tuple(self.cursor.fetchone())
+
+    def statement_stats(self, limit):
+        # None without pg_stat_statements; times in seconds like the local history
+        self.cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements';")
+        if self.cursor.fetchone() is None:
+            return None
+        suffix = 'exec_time' if self.db.server_version >= 130000 else 'time'
+        try:
             self.cursor.execute(
-                "SELECT DISTINCT ccu.table_name AS foreign_table, ccu.column_name AS foreign_column "
-                "FROM information_schema.table_constraints AS tc "
-                "JOIN information_schema.key_column_usage AS kcu "
-                "ON tc.constraint_name = kcu.constraint_name "
-                "JOIN information_schema.constraint_column_usage AS ccu "
-                "ON ccu.constraint_name = tc.constraint_name "
-                "WHERE constraint_type = 'FOREIGN KEY' AND tc.table_name = %s;",
-                (table,)
-            )
-            foreign_keys = self.cursor.fetchall()
+                f"SELECT query, calls, total_{suffix} / 1000, mean_{suffix} / 1000, rows FROM pg_stat_statements "
+                f"WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database()) "
+                f"ORDER BY total_{suffix} DESC LIMIT %s;", (limit,))
+        except psycopg2.Error as e:
+            # Installed but not loaded through shared_preload_libraries
+            print(f"Error reading pg_stat_statements: {e}")
+            self.db.rollback()
+            return None
+        return [ServerStatement(fingerprint(query), query, calls, total, mean, rows)
+                for query, calls, total, mean, rows in self.cursor.fetchall()]
 
-            for foreign_key in foreign_keys:
-                foreign_table, foreign_column = foreign_key
-                create_table_script += f",\nFOREIGN KEY ({foreign_column}) REFERENCES {foreign_table} ({foreign_column})"
+    def invalidate_row_count(self, table=None):
+        self.note_write()
+        if table is None:
+            self._row_counts.clear()
+        else:
+            self._row_counts.pop(table, None)
 
-            create_table_script += "\nTABLESPACE pg_default;\n"
-            create_table_script += f"\nALTER TABLE IF EXISTS {table}\n    OWNER to postgres;\n"
+    def table_sql(self, table):
+        return self._cached(('table_sql', table), lambda: self._load_table_sql(table))
 
-            return create_table_script
-        except Exception as e:
-            print(f"Error getting SQL query for table: {e}")
+    def _load_table_sql(self, table):
+        schema = self.table_schema(table)
+        if schema is None:
             return None
 
-    def update_cell(self, sql):
+        lines = []
+        for column in schema.columns:
+            line = f"    {column.name} {column.full_type}"
+            if not column.nullable:
+                line += " NOT NULL"
+            if column.default is not None:
+                line += f" DEFAULT {column.default}"
+            lines.append(line)
+        if schema.primary_key:
+            lines.append(f"    PRIMARY KEY ({', '.join(schema.primary_key)})")
+        for foreign_key in schema.foreign_keys:
+            lines.append(f"    FOREIGN KEY ({', '.join(foreign_key.columns)}) "
+                         f"REFERENCES {foreign_key.foreign_table} ({', '.join(foreign_key.foreign_columns)})")
+
+        create_table_script = f"CREATE TABLE IF NOT EXISTS {table} (\n"
+        create_table_script += ",\n".join(lines) + "\n)"
+        create_table_script += "\nTABLESPACE pg_default;\n"
+        create_table_script += f"\nALTER TABLE IF EXISTS {table}\n    OWNER to {schema.owner};\n"
+        return create_table_script
+
+    def row_identity(self, table):
+        # (name, expression, type) of what identifies a row: the primary key,
+        # or the tuple's physical location plus the inserting transaction
+        schema = self.table_schema(table)
+        if schema is None:
+            return None
+        if schema.primary_key:
+            types = {column.name: column.full_type for column in schema.columns}
+            return [(name, pg_sql.Identifier(name), types[name]) for name in schema.primary_key]
+        return [('ctid', pg_sql.SQL('ctid'), 'tid'), ('xmin', pg_sql.SQL('xmin'), 'xid')]
+
+    def _parse_row_key(self, identity, key):
+        if isinstance(key, dict):
+            key = [key[name] for name, _, _ in identity]
+        key = tuple(copy_value(value) for value in key)
+        if len(key) != len(identity) or None in key:
+            raise ValueError('Malformed row key')
+        return key
+
+    def _key_join(self, identity, alias='t'):
+        keys = [pg_sql.Identifier(f'k{i}') for i in range(len(identity))]
+        condition = pg_sql.SQL(' AND ').join(
+            pg_sql.SQL('{}.{} = v.{}::{}').format(pg_sql.Identifier(alias), expression, key, pg_sql.SQL(type_name))
+            for (_, expression, type_name), key in zip(identity, keys))
+        return keys, condition
+
+    def update_cells(self, table, changes):
+        # changes: [{'pk': [...] or {...}, 'column': name, 'value': text or None}]
+        identity = self.row_identity(table)
+        if identity is None:
+            return [{'ok': False, 'error': 'Unknown table'} for _ in changes]
+        types = {column.name: column.full_type for column in self.get_table_info(table)}
+        results = [None] * len(changes)
+        groups = OrderedDict()
+        for n, change in enumerate(changes):
+            try:
+                column = change['column']
+                key = self._parse_row_key(identity, change['pk'])
+                value = copy_value(change.get('value'))
+            except (KeyError, TypeError, ValueError):
+                results[n] = {'ok': False, 'error': 'Malformed change'}
+                continue
+            if column not in types:
+                results[n] = {'ok': False, 'error': 'Unknown column'}
+                continue
+            edits = groups.setdefault(column, OrderedDict())
+            # A later edit of the same cell supersedes an earlier one
+            previous = edits.pop(key, None)
+            if previous is not None:
+                results[previous[0]] = {'ok': True}
+            edits[key] = (n, value)
+
+        # An update moves the row to a new ctid/xmin (or a new key, when the key
+        # column itself is edited), so later groups follow it: original -> current key
+        moved = {}
+        conn = self.db
+        with conn.cursor() as cursor:
+            for column, edits in groups.items():
+                rows = [(n, value, key) for key, (n, value) in edits.items()]
+                self._update_column(cursor, table, identity, types, column, rows, results, moved)
+        conn.commit()
+        self.note_write()
+        return results
+
+    def _update_column(self, cursor, table, identity, types, column, rows, results, moved):
+        keys, condition = self._key_join(identity)
+        sql = pg_sql.SQL(
+            'UPDATE {} AS t SET {} = v.value::{} FROM (VALUES {}) AS v(n, value, {}) WHERE {} RETURNING v.n, {}'
+        ).format(
+            pg_sql.Identifier(table), pg_sql.Identifier(column), pg_sql.SQL(types[column]),
+            pg_sql.SQL(', ').join(pg_sql.SQL('({})').format(pg_sql.SQL(', ').join(pg_sql.Placeholder() * (2 + len(keys))))
+                                  for _ in rows),
+            pg_sql.SQL(', ').join(keys),
+            condition,
+            pg_sql.SQL(', ').join(pg_sql.SQL('t.{}::text').format(expression) for _, expression, _ in identity))
+        params = []
+        for n, value, key in rows:
+            params += [n, value] + list(moved.get(key, key))
+        cursor.execute('SAVEPOINT update_cells')
         try:
-            self.cursor.execute(sql)
-            self.db.commit()
-        except Exception as e:
-            print(f"Error updating the cell: {e}")
+            cursor.execute(sql, params)
+            updated = {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+        except psycopg2.Error as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT update_cells')
+            cursor.execute('RELEASE SAVEPOINT update_cells')
+            if len(rows) == 1:
+                results[rows[0][0]] = {'ok': False, 'error': e.diag.message_primary or str(e)}
+                return
+            # Find the edits that failed one by one
+            for row in rows:
+                self._update_column(cursor, table, identity, types, column, [row], results, moved)
+            return
+        cursor.execute('RELEASE SAVEPOINT update_cells')
+        for n, _, key in rows:
+            if n in updated:
+                moved[key] = updated[n]
+                results[n] = {'ok': True, 'pk': list(updated[n])}
+            else:
+                results[n] = {'ok': False, 'error': 'The row does not exist or was changed by someone else'}
+
+    def delete_rows(self, table, keys):
+        identity = self.row_identity(table)
+        keys = [self._parse_row_key(identity, key) for key in keys]
+        if not keys:
+            return 0
+        key_names, condition = self._key_join(identity)
+        sql = pg_sql.SQL('DELETE FROM {} AS t USING (VALUES {}) AS v({}) WHERE {}').format(
+            pg_sql.Identifier(table),
+            pg_sql.SQL(', ').join(pg_sql.SQL('({})').format(pg_sql.SQL(', ').join(pg_sql.Placeholder() * len(identity)))
+                                  for _ in keys),
+            pg_sql.SQL(', ').join(key_names),
+            condition)
+        params = [value for key in keys for value in key]
+        if identity[0][0] == 'ctid' and not self.table_schema(table).primary_key:
+            # Spell out the ctid list so the planner always picks a TID scan
+            sql += pg_sql.SQL(' AND t.ctid = ANY(%s::tid[])')
+            params.append([key[0] for key in keys])
+        self.cursor.execute(sql, params)
+        deleted = self.cursor.rowcount
+        self.db.commit()
+        self.invalidate_row_count(table)
+        return deleted
 
     def get_table_info(self, table):
-        try:
-            self.cursor.execute(
-                "SELECT column_name, data_type, is_nullable, column_default FROM information_schema.columns WHERE table_name = %s;",
-                (table,)
-            )
-            info = self.cursor.fetchall()
+        schema = self.table_schema(table)
+        return schema.columns if schema is not None else None
 
-            # Retrieve primary key column names
-            self.cursor.execute(
-                "SELECT column_name FROM information_schema.key_column_usage WHERE table_name = %s AND constraint_name = (SELECT constraint_name FROM information_schema.table_constraints WHERE table_name = %s AND constraint_type = 'PRIMARY KEY');",
-                (table, table)
-            )
-            primary_key_columns = [row[0] for row in self.cursor.fetchall()]
-
-            updated_info = []
-            for col_info in info:
-                updated_col_info = col_info + (('YES',) if col_info[0] in primary_key_columns else ('NO',))
-                updated_info.append(updated_col_info)
+    def table_schema(self, table):
+        return self._cached(('schema', table), lambda: self._load_schema(table).get(table))
 
-            return updated_info
+    def _load_schema(self, table):
+        try:
+            self.cursor.execute(SCHEMA_SQL + " AND c.relname = %s;", (table,))
+            rows = self.cursor.fetchall()
         except Exception as e:
             print(f"Error getting table information: {e}")
-            return None
+            self.db.rollback()
+            return {}
+
+        schemas = {}
+        for name, owner, columns, constraints, indexes in rows:
+            primary_key = []
+            foreign_keys = []
+            for constraint_name, constraint_type, key_columns, foreign_table, foreign_columns in constraints or []:
+                if constraint_type == 'p':
+                    primary_key = key_columns
+                else:
+                    foreign_keys.append(ForeignKey(constraint_name, key_columns, foreign_table, foreign_columns))
+            schemas[name] = TableSchema(
+                name=name,
+                owner=owner,
+                columns=[Column(col_name, data_type, nullable, default, col_name in primary_key, full_type)
+                         for col_name, data_type, nullable, default, full_type in columns or []],
+                primary_key=primary_key,
+                foreign_keys=foreign_keys,
+                indexes=[Index(*index) for index in indexes or []],
+            )
+        return schemas
+
+    def _set_statement_timeout(self, conn, timeout):
+        if timeout:
+            with conn.cursor() as cursor:
+                cursor.execute('SET LOCAL statement_timeout = %s', (int(timeout),))
+
+    def execute_query(self, sql, limit, timeout=None, max_bytes=None, fetch_size=QUERY_FETCH_SIZE):
+        if self.replica is not None and is_read_query(sql):
+            try:
+                with self.connection(read=True) as conn:
+                    return self._execute_query(conn, sql, limit, timeout, max_bytes, fetch_size)
+            except pg_errors.ReadOnlySqlTransaction:
+                # Looked like a read but writes (a volatile function, a data-modifying WITH)
+                result = self._execute_query(self.db, sql, limit, timeout, max_bytes, fetch_size)
+                self.note_write()
+                return result
+        return self._execute_query(self.db, sql, limit, timeout, max_bytes, fetch_size)
+
+    def _execute_query(self, conn, sql, limit, timeout, max_bytes, fetch_size):
+        self._set_statement_timeout(conn, timeout)
+        if is_read_query(sql):
+            cursor = conn.cursor(name=f'console_{uuid.uuid4().hex}')
+        else:
+            cursor = conn.cursor()
+            cursor.log_history = False
+        try:
+            cursor.execute(sql)
+            rows, has_more, size = [], False, 0
+            if cursor.name is not None or cursor.description is not None:
+                while not has_more:
+                    batch = cursor.fetchmany(min(fetch_size, limit + 1 - len(rows)))
+                    if not batch:
+                        break
+                    for row in batch:
+                        size += sum(len(str(value)) for value in row)
+                        if len(rows) == limit or (max_bytes and size > max_bytes):
+                            has_more = True
+                            break
+                        rows.append(row)
+            description = cursor.description
+            row_count = len(rows) if description is not None else cursor.rowcount
+        finally:
+            cursor.close()
+        conn.commit()
+        return QueryResult(description, rows, row_count, has_more)
+
+    def explain(self, sql, analyze=True, rollback=True, timeout=None):
+        # EXPLAIN ANALYZE really runs the statement, so by default its changes are rolled back
+        options = 'ANALYZE, BUFFERS, FORMAT JSON' if analyze else 'FORMAT JSON'
+        conn = self.db
+        try:
+            self._set_statement_timeout(conn, timeout)
+            with conn.cursor() as cursor:
+                cursor.execute(f"EXPLAIN ({options}) {sql.strip().rstrip(';')}")
+                plan = cursor.fetchone()[0]
+        except Exception:
+            conn.rollback()
+            raise
+        if analyze and not rollback:
+            conn.commit()
+            if not is_read_query(sql):
+                self.invalidate_row_count()
+                self.invalidate_schema()
+        else:
+            conn.rollback()
+        return plan[0]
+
+    def stream_query(self, sql, timeout=None, fetch_size=QUERY_FETCH_SIZE, read=True):
+        # The rows outlive the request's own connection, so use a dedicated one
+        pool, conn = self._getconn(read)
+        cursor = conn.cursor(name=f'stream_{uuid.uuid4().hex}')
+        cursor.itersize = fetch_size
+        try:
+            self._set_statement_timeout(conn, timeout)
+            cursor.execute(sql)
+            # A named cursor has no description until the first FETCH
+            first = cursor.fetchmany(fetch_size)
+        except pg_errors.ReadOnlySqlTransaction:
+            pool.putconn(conn)
+            if pool is self.pool:
+                raise
+            return self.stream_query(sql, timeout, fetch_size, read=False)
+        except Exception:
+            pool.putconn(conn)
+            raise
+
+        def rows():
+            try:
+                yield from first
+                yield from cursor
+            finally:
+                pool.putconn(conn)
+
+        return cursor.description, rows()
+
+    def copy_to(self, query, fmt, chunk_size=EXPORT_CHUNK_SIZE, queue_size=EXPORT_QUEUE_SIZE, read=False):
+        # copy_expert() blocks until COPY is done, so it runs in a thread that
+        # fills a bounded queue while the response drains it
+        sql = copy_to_sql(query, fmt)
+        pool, conn = self._getconn(read)
+        chunks = queue.Queue(maxsize=queue_size)
+        cancelled = threading.Event()
+        writer = QueueWriter(chunks, cancelled, chunk_size)
+        failure = []
+
+        def copy():
+            try:
+                with conn.cursor() as cursor:
+                    cursor.copy_expert(sql, writer)
+                writer.flush()
+                conn.rollback()
+            except Exception as e:
+                failure.append(e)
+            finally:
+                try:
+                    writer.put(None)
+                except IOError:
+                    pass
+
+        def stream():
+            thread = threading.Thread(target=copy, name='copy-to', daemon=True)
+            thread.start()
+            sent = False
+            try:
+                while True:
+                    chunk = chunks.get()
+                    if chunk is None:
+                        break
+                    sent = True
+                    yield chunk
+                if failure:
+                    if not sent:
+                        raise failure[0]
+                    # Too late to report it in the response, the download is just cut short
+                    print(f"Error exporting data: {failure[0]}")
+            finally:
+                if thread.is_alive():
+                    cancelled.set()
+                    conn.cancel()
+                    thread.join()
+                pool.putconn(conn, close=bool(failure) or cancelled.is_set())
+
+        return stream()
+
+    def export_table(self, table, fmt):
+        return self.copy_to(pg_sql.SQL('SELECT * FROM {}').format(pg_sql.Identifier(table)), fmt, read=True)
+
+    def export_query(self, sql, fmt):
+        return self.copy_to(pg_sql.SQL(sql.strip().rstrip(';')), fmt, read=is_read_query(sql))
 
     def get_foreign_keys(self, table):
-        return self.cursor.execute("PRAGMA foreign_key_list('%s')" % table).fetchall()
+        schema = self.table_schema(table)
+        return schema.foreign_keys if schema else []
 
     def get_indexes(self, table):
-        return self.cursor.execute("PRAGMA index_list('%s')" % table).fetchall()
+        # Usage counters are live, so unlike the schema model this is never cached
+        self.cursor.execute("""
+            SELECT c.relname, array(SELECT a.attname FROM unnest(i.indkey) WITH ORDINALITY AS k(attnum, n)
+                                    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                                    ORDER BY k.n),
+                   i.indisunique, i.indisprimary, i.indisvalid, am.amname, pg_get_indexdef(i.indexrelid),
+                   pg_relation_size(i.indexrelid), coalesce(s.idx_scan, 0), coalesce(s.idx_tup_read, 0),
+                   con.conname, i.indkey::text, i.indclass::text, pg_get_expr(i.indexprs, i.indrelid),
+                   pg_get_expr(i.indpred, i.indrelid)
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_class t ON t.oid = i.indrelid
+            JOIN pg_am am ON am.oid = c.relam
+            LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = i.indexrelid
+            LEFT JOIN pg_constraint con ON con.conindid = i.indexrelid AND con.contype IN ('p', 'u', 'x')
+            WHERE t.relname = %s AND t.relnamespace = 'public'::regnamespace
+            ORDER BY i.indisprimary DESC, c.relname;""", (table,))
+        rows = self.cursor.fetchall()
+
+        def redundant_to(row):
+            # An exact copy of another index, or a btree prefix of a longer one
+            name, _, unique, _, _, method, _, _, _, _, constraint, keys, classes, expressions, predicate = row
+            if constraint:
+                return None
+            for other in rows:
+                if other[0] == name or other[5] != method or other[13:] != (expressions, predicate):
+                    continue
+                other_keys, other_classes = other[11].split(), other[12].split()
+                if (keys, classes) == (other[11], other[12]):
+                    # Of two identical indexes keep the constraint-backed or unique one, else either
+                    mine, theirs = (bool(constraint), unique), (bool(other[10]), other[2])
+                    if theirs > mine or (theirs == mine and other[0] < name):
+                        return other[0]
+                elif (method == 'btree' and not unique and keys.split() == other_keys[:len(keys.split())]
+                      and classes.split() == other_classes[:len(classes.split())]):
+                    return other[0]
+            return None
 
-    def paginate(self, table, page, paginate_by=20, order=None):
+        return [IndexStats(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9],
+                           row[10], not row[8] and not row[2] and not row[3] and not row[10],
+                           redundant_to(row))
+                for row in rows]
+
+    def index_build_progress(self, pid):
+        self.cursor.execute("""
+            SELECT phase, blocks_done, blocks_total, tuples_done, tuples_total, lockers_done, lockers_total
+            FROM pg_stat_progress_create_index WHERE pid = %s;""", (pid,))
+        row = self.cursor.fetchone()
+        self.db.commit()
+        if row is None:
+            return None
+        phase, blocks_done, blocks_total, tuples_done, tuples_total, lockers_done, lockers_total = row
+        if blocks_total:
+            percent = 100.0 * blocks_done / blocks_total
+        elif tuples_total:
+            percent = 100.0 * tuples_done / tuples_total
+        elif lockers_total:
+            percent = 100.0 * lockers_done / lockers_total
+        else:
+            percent = None
+        return {'phase': phase, 'percent': None if percent is None else round(percent, 1),
+                'blocks_done': blocks_done, 'blocks_total': blocks_total,
+                'tuples_done': tuples_done, 'tuples_total': tuples_total}
+
+    def drop_index(self, name):
+        # DROP INDEX CONCURRENTLY can't run inside a transaction block
+        with self.connection() as conn:
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(pg_sql.SQL('DROP INDEX CONCURRENTLY {}').format(pg_sql.Identifier(name)))
+            finally:
+                conn.autocommit = False
+        self.invalidate_schema()
+
+    def paginate(self, table, page, paginate_by=20, order=None, with_row_id=False, where=None):
+        # with_row_id appends ctid and xmin to every row, for tables without a primary key;
+        # where is a (condition, params) pair from combine_predicates()
         if page > 0:
             page -= 1
+        sql = pg_sql.SQL('SELECT *{} FROM {}').format(
+            pg_sql.SQL(', ctid::text, xmin::text' if with_row_id else ''), pg_sql.Identifier(table))
+        params = []
+        if where:
+            sql += pg_sql.SQL(' WHERE ') + where[0]
+            params += where[1]
         if order:
-            sql = 'SELECT * FROM %s ORDER BY %s LIMIT %%s OFFSET %%s;' % (table, order)
-        else:
-            sql = 'SELECT * FROM %s LIMIT %%s OFFSET %%s;' % table
+            column, descending = parse_order(order)
+            sql += pg_sql.SQL(' ORDER BY {} {}').format(
+                pg_sql.Identifier(column), pg_sql.SQL('DESC' if descending else 'ASC'))
+        sql += pg_sql.SQL(' LIMIT %s OFFSET %s;')
 
         try:
-            self.cursor.execute(sql, (paginate_by, page * paginate_by))
+            self.cursor.execute(sql, params + [paginate_by, page * paginate_by])
             table_page = self.cursor.fetchall()
             return table_page
         except Exception as e:
             print(f"Error when executing the paginate request: {e}")
+            self.db.rollback()
             return None
 
+    def keyset_columns(self, table, order=None):
+        info = self.get_table_info(table) or []
+        nullable = {column.name: column.nullable for column in info}
+        primary_key = [column.name for column in info if column.primary_key]
+        if not primary_key:
+            return None
+        column, descending = parse_order(order)
+        if column is None:
+            column = primary_key[0]
+        elif column not in nullable:
+            return None
+        # The primary key is the tiebreaker that makes the ordering unique
+        keys = [(column, descending, nullable[column] and column not in primary_key)]
+        keys += [(name, descending, False) for name in primary_key if name != column]
+        return keys
+
+    def paginate_keyset(self, table, paginate_by=20, order=None, after=None, before=None, where=None):
+        keys = self.keyset_columns(table, order)
+        if keys is None:
+            return None
+        token = before or after
+        values = decode_cursor(token) if token else None
+        if token and (values is None or len(values) != len(keys)):
+            return None
+        backwards = before is not None
+        if backwards:
+            keys = [(name, not descending, nullable) for name, descending, nullable in keys]
+
+        sql = pg_sql.SQL('SELECT * FROM {}').format(pg_sql.Identifier(table))
+        conditions, params = [], []
+        if where:
+            conditions.append(where[0])
+            params += where[1]
+        if values is not None:
+            condition, seek_params = seek_condition(keys, values)
+            conditions.append(condition)
+            params += seek_params
+        if conditions:
+            sql += pg_sql.SQL(' WHERE ') + pg_sql.SQL(' AND ').join(conditions)
+        sql += pg_sql.SQL(' ORDER BY {} LIMIT %s;').format(pg_sql.SQL(', ').join(
+            pg_sql.SQL('{} {}').format(pg_sql.Identifier(name), pg_sql.SQL('DESC' if descending else 'ASC'))
+            for name, descending, _ in keys))
+        params.append(paginate_by + 1)
+
+        try:
+            self.cursor.execute(sql, params)
+            rows = self.cursor.fetchall()
+        except Exception as e:
+            print(f"Error when executing the keyset paginate request: {e}")
+            self.db.rollback()
+            return None
+
+        has_more = len(rows) > paginate_by
+        rows = rows[:paginate_by]
+        if backwards:
+            rows.reverse()
+        columns = [column.name for column in self.get_table_info(table)]
+        positions = [columns.index(name) for name, _, _ in keys]
+
+        def cursor_for(row):
+            return encode_cursor([row[position] for position in positions])
+
+        if not rows:
+            return Page(rows, None, None)
+        if backwards:
+            return Page(rows, cursor_for(rows[-1]), cursor_for(rows[0]) if has_more else None)
+        return Page(rows, cursor_for(rows[-1]) if has_more else None,
+                    cursor_for(rows[0]) if values is not None else None)
+
 
     def delete_table(self, table):
         self.cursor.execute("DROP TABLE %s" % table)
+        self.db.commit()
+        self.invalidate_schema()
 
     def copy_table(self, old_table, new_table):
         infos = self.get_table_info(old_table)
@@ -191,55 +2025,44 @@ class PostgresTools():
 
     def delete_column(self, table, column):
         try:
-            self.cursor.execute(
-                "SELECT column_name FROM information_schema.columns WHERE table_name = %s",
-                (table,)
-            )
-            existing_columns = [row[0] for row in self.cursor.fetchall()]
+            existing_columns = [column.name for column in self.get_table_info(table)]
 
             if column not in existing_columns:
                 flash('The column "%s" does not exist in the table' % column, 'danger')
                 return
 
             sql = f'ALTER TABLE {table} DROP COLUMN {column}'
-            print(sql)
             self.cursor.execute(sql)
 
             flash('Column "%s" has been successfully deleted from the table' % column, 'success')
         except Exception as e:
             print(f"Error deleting column: {e}")
+            self.db.rollback()
             flash('An error occurred when deleting a column: %s' % e, 'danger')
         finally:
             self.db.commit()
+            self.invalidate_schema()
 
     def add_column(self, table, column, column_type2, not_null, atr):
         try:
-            self.cursor.execute(
-                "SELECT column_name FROM information_schema.columns WHERE table_name = %s",
-                (table,)
-            )
-            existing_columns = [row[0] for row in self.cursor.fetchall()]
+            existing_columns = [column.name for column in self.get_table_info(table)]
 
             if column in existing_columns:
                 return False
             self.cursor.execute('ALTER TABLE %s ADD COLUMN %s %s %s' % (table, column, column_type2, not_null))
 
             self.db.commit()
+            self.invalidate_schema()
 
             return True
         except Exception as e:
             print(f"Error adding column: {e}")
+            self.db.rollback()
             return False
 
     def add_row(self, table, values):
         try:
-            self.cursor.execute(
-                "SELECT column_name, is_nullable, data_type FROM information_schema.columns WHERE table_name = %s;",
-                (table,)
-            )
-            columns_info = self.cursor.fetchall()
-
-            column_names = [col_info[0] for col_info in columns_info]
+            column_names = [column.name for column in self.get_table_info(table)]
 
             query = f"INSERT INTO {table} ("
             query += ", ".join(column_names)
@@ -263,13 +2086,683 @@ class PostgresTools():
 
             self.cursor.execute(query, values_to_insert)
             self.db.commit()
+            self.invalidate_row_count(table)
         except Exception as e:
+            self.db.rollback()
             flash(f'{e}', 'danger')
 
+
+def copy_value(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def csv_line(values):
+    # Quote every value so that only None turns into NULL
+    return ','.join('' if value is None else '"%s"' % value.replace('"', '""') for value in values) + '\n'
+
+
+class ImportTask():
+
+    def __init__(self, tools, table, path, fmt, commit_mode='batch', batch_size=IMPORT_BATCH_SIZE):
+        self.id = uuid.uuid4().hex
+        self.tools = tools
+        self.table = table
+        self.path = path
+        self.fmt = fmt
+        self.commit_mode = commit_mode
+        self.batch_size = batch_size
+        self.status = 'pending'
+        self.columns = []
+        self.ignored_columns = []
+        self.rows_loaded = 0
+        self.rows_rejected = 0
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.error_path = None
+        self.thread = None
+        self._error_file = None
+        self._error_writer = None
+        self._error_header = None
+        self._cancelled = threading.Event()
+        self._conn = None
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rows_per_second(self):
+        return round(self.rows_loaded / self.elapsed) if self.elapsed else 0
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'table': self.table,
+            'status': self.status,
+            'columns': self.columns,
+            'ignored_columns': self.ignored_columns,
+            'rows_loaded': self.rows_loaded,
+            'rows_rejected': self.rows_rejected,
+            'rows_per_second': self.rows_per_second,
+            'elapsed': round(self.elapsed, 1),
+            'error': self.error,
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f'import-{self.id}', daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        # Batches committed so far stay loaded
+        self._cancelled.set()
+        conn = self._conn
+        if conn is not None:
+            conn.cancel()
+
+    def run(self):
+        self.started = time.time()
+        self.status = 'running'
+        try:
+            # utf-8-sig drops the byte order mark Excel puts before the header
+            with open(self.path, newline='', encoding='utf-8-sig') as file:
+                records = self._csv_records(file) if self.fmt == 'csv' else self._jsonl_records(file)
+                with self.tools.connection() as conn:
+                    self._conn = conn
+                    try:
+                        self._copy(conn, records)
+                    finally:
+                        self._conn = None
+            self.status = 'cancelled' if self._cancelled.is_set() else 'finished'
+        except psycopg2.extensions.QueryCanceledError:
+            self.status = 'cancelled'
+        except Exception as e:
+            print(f"Error importing into {self.table}: {e}")
+            self.status = 'failed'
+            self.error = str(e)
+        finally:
+            self.finished = time.time()
+            if self._error_file is not None:
+                self._error_file.close()
+            os.remove(self.path)
+            self.tools.invalidate_row_count(self.table)
+            # Metadata lookups above checked out a connection for this thread
+            self.tools.release()
+
+    def _map_columns(self, names):
+        table_columns = [column.name for column in self.tools.get_table_info(self.table)]
+        lookup = {name.lower(): name for name in table_columns}
+        positions = []
+        for position, name in enumerate(names):
+            column = name if name in table_columns else lookup.get(str(name).strip().lower())
+            if column is None or column in self.columns:
+                self.ignored_columns.append(name)
+                continue
+            self.columns.append(column)
+            positions.append(position)
+        if not self.columns:
+            raise ValueError('None of the columns in the file exist in the table')
+        return positions
+
+    def _csv_records(self, file):
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header is None:
+            raise ValueError('The file is empty')
+        self._error_header = header + ['error']
+        positions = self._map_columns(header)
+
+        def records():
+            for row in reader:
+                if len(row) != len(header):
+                    yield row, None, f'Expected {len(header)} fields, got {len(row)}'
+                    continue
+                # Like COPY itself, an empty CSV field is NULL
+                yield row, [row[position] or None for position in positions], None
+
+        return records()
+
+    def _jsonl_records(self, file):
+        lines = (line for line in file if line.strip())
+        first = next(lines, None)
+        if first is None:
+            raise ValueError('The file is empty')
+        try:
+            keys = list(json.loads(first))
+        except (ValueError, TypeError):
+            raise ValueError('The first line is not a JSON object')
+        self._error_header = ['line', 'error']
+        # Keys that map to no column, here or first seen on later lines, are ignored like CSV columns
+        keys = [keys[position] for position in self._map_columns(keys)]
+
+        def records():
+            for line in itertools.chain([first], lines):
+                raw = [line.rstrip('\r\n')]
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    yield raw, None, f'Invalid JSON: {e}'
+                    continue
+                if not isinstance(record, dict):
+                    yield raw, None, 'Not a JSON object'
+                    continue
+                yield raw, [copy_value(record.get(key)) for key in keys], None
+
+        return records()
+
+    def _reject(self, raw, reason):
+        if self._error_writer is None:
+            fd, self.error_path = tempfile.mkstemp(prefix='import-errors-', suffix='.csv')
+            self._error_file = os.fdopen(fd, 'w', newline='', encoding='utf-8')
+            self._error_writer = csv.writer(self._error_file)
+            self._error_writer.writerow(self._error_header)
+        self._error_writer.writerow(list(raw) + [reason])
+        self.rows_rejected += 1
+
+    def _copy(self, conn, records):
+        self.copy_sql = pg_sql.SQL('COPY {} ({}) FROM STDIN WITH (FORMAT csv)').format(
+            pg_sql.Identifier(self.table), pg_sql.SQL(', ').join(map(pg_sql.Identifier, self.columns)))
+        with conn.cursor() as cursor:
+            batch = []
+            for raw, values, problem in records:
+                if self._cancelled.is_set():
+                    conn.rollback()
+                    return
+                if problem is not None:
+                    self._reject(raw, problem)
+                    continue
+                batch.append((raw, csv_line(values)))
+                if len(batch) >= self.batch_size:
+                    self._load(cursor, batch)
+                    batch = []
+                    if self.commit_mode == 'batch':
+                        conn.commit()
+            if batch:
+                self._load(cursor, batch)
+        conn.commit()
+
+    def _load(self, cursor, batch):
+        # Bisect failing batches down to the rows COPY rejects
+        cursor.execute('SAVEPOINT import_batch')
+        try:
+            cursor.copy_expert(self.copy_sql, io.StringIO(''.join(line for _, line in batch)))
+        except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT import_batch')
+            cursor.execute('RELEASE SAVEPOINT import_batch')
+            if len(batch) == 1:
+                self._reject(batch[0][0], e.diag.message_primary or str(e))
+                return
+            middle = len(batch) // 2
+            self._load(cursor, batch[:middle])
+            self._load(cursor, batch[middle:])
+            return
+        cursor.execute('RELEASE SAVEPOINT import_batch')
+        self.rows_loaded += len(batch)
+
+
+import_tasks = OrderedDict()
+import_tasks_lock = threading.Lock()
+
+
+def register_import(task):
+    with import_tasks_lock:
+        import_tasks[task.id] = task
+        for old_id in list(import_tasks):
+            if len(import_tasks) <= app.config['IMPORT_HISTORY_SIZE']:
+                break
+            old = import_tasks[old_id]
+            if old.status in ('finished', 'failed', 'cancelled'):
+                del import_tasks[old_id]
+                if old.error_path and os.path.exists(old.error_path):
+                    os.remove(old.error_path)
+
+
+class QueryJob():
+
+    def __init__(self, tools, table, sql, timeout=JOB_TIMEOUT, max_rows=JOB_MAX_ROWS, fetch_size=QUERY_FETCH_SIZE):
+        self.id = uuid.uuid4().hex
+        self.tools = tools
+        self.table = table
+        self.sql = sql
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.fetch_size = fetch_size
+        self.status = 'pending'
+        self.description = None
+        self.rows = []
+        self.row_count = None
+        self.truncated = False
+        self.backend_pid = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.future = None
+        self._conn = None
+        self._cancelled = threading.Event()
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def done(self):
+        return self.status in ('finished', 'failed', 'cancelled')
+
+    @property
+    def columns(self):
+        return [column[0] for column in self.description or []]
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'table': self.table,
+            'status': self.status,
+            'rows_fetched': len(self.rows),
+            'row_count': self.row_count,
+            'truncated': self.truncated,
+            'columns': self.columns,
+            'backend_pid': self.backend_pid,
+            'elapsed': round(self.elapsed, 1),
+            'error': self.error,
+        }
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None and self.future.cancel():
+            self.status = 'cancelled'
+            self.finished = time.time()
+            return
+        conn = self._conn
+        if conn is not None:
+            # Sends a cancel request for the running statement, like pg_cancel_backend()
+            conn.cancel()
+
+    def run(self):
+        if self._cancelled.is_set():
+            self.status = 'cancelled'
+            return
+        self.started = time.time()
+        self.status = 'running'
+        try:
+            try:
+                self._run(read=is_read_query(self.sql))
+            except pg_errors.ReadOnlySqlTransaction:
+                # Looked like a read but writes, so it goes to the primary after all
+                self.description, self.rows, self.truncated = None, [], False
+                self._run(read=False)
+                self.tools.note_write()
+            self.status = 'cancelled' if self._cancelled.is_set() else 'finished'
+        except psycopg2.extensions.QueryCanceledError as e:
+            self.status = 'cancelled' if self._cancelled.is_set() else 'failed'
+            self.error = None if self._cancelled.is_set() else str(e)
+        except Exception as e:
+            print(f"Error running query job {self.id}: {e}")
+            self.status = 'failed'
+            self.error = str(e)
+        finally:
+            self.finished = time.time()
+            query_history.add(self.tools.location, 'job', self.sql, self.elapsed, self.row_count, self.error)
+
+    def _run(self, read):
+        with self.tools.connection(read=read) as conn:
+            self._conn = conn
+            self.backend_pid = conn.get_backend_pid()
+            try:
+                self._execute(conn)
+            finally:
+                self._conn = None
+
+    def _execute(self, conn):
+        read = is_read_query(self.sql)
+        self.tools._set_statement_timeout(conn, self.timeout)
+        cursor = conn.cursor(name=f'job_{self.id}') if read else conn.cursor()
+        cursor.log_history = False
+        try:
+            cursor.execute(self.sql)
+            if cursor.name is not None or cursor.description is not None:
+                while not self._cancelled.is_set():
+                    batch = cursor.fetchmany(self.fetch_size)
+                    if not batch:
+                        break
+                    # A named cursor only knows its columns after the first FETCH
+                    self.description = cursor.description
+                    room = self.max_rows - len(self.rows)
+                    if len(batch) > room:
+                        self.rows.extend(batch[:room])
+                        self.truncated = True
+                        break
+                    self.rows.extend(batch)
+                self.description = cursor.description
+                self.row_count = len(self.rows)
+            else:
+                self.row_count = cursor.rowcount
+        finally:
+            cursor.close()
+        if self._cancelled.is_set():
+            conn.rollback()
+            return
+        conn.commit()
+        if not read:
+            self.tools.invalidate_row_count()
+            self.tools.invalidate_schema()
+
+    def page(self, page, paginate_by):
+        start = (page - 1) * paginate_by
+        return self.rows[start:start + paginate_by]
+
+
+class QueryJobs():
+    # Jobs are kept in least recently used order; finished results expire after
+    # result_ttl seconds or when more than history_size jobs are kept
+
+    def __init__(self):
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def submit(self, job, workers=JOB_WORKERS, result_ttl=JOB_RESULT_TTL, history_size=JOB_HISTORY_SIZE):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='query-job')
+            self._expire(result_ttl, history_size)
+            self.jobs[job.id] = job
+            job.future = self.executor.submit(job.run)
+        return job
+
+    def get(self, job_id, result_ttl=JOB_RESULT_TTL, history_size=JOB_HISTORY_SIZE):
+        with self.lock:
+            self._expire(result_ttl, history_size)
+            job = self.jobs.get(job_id)
+            if job is not None:
+                self.jobs.move_to_end(job_id)
+            return job
+
+    def cancel_all(self, tools=None):
+        cancelled = []
+        with self.lock:
+            for job in self.jobs.values():
+                if not job.done and (tools is None or job.tools is tools):
+                    job.cancel()
+                    cancelled.append(job)
+        return cancelled
+
+    def _expire(self, result_ttl, history_size):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if not job.done:
+                continue
+            if len(self.jobs) > history_size or now - (job.finished or now) > result_ttl:
+                del self.jobs[job_id]
+
+
+query_jobs = QueryJobs()
+
+
+def truncate_identifier(name, limit=63):
+    # PostgreSQL cuts identifiers to 63 bytes, never inside a character
+    return name.encode('utf-8')[:limit].decode('utf-8', 'ignore')
+
+
+def index_name(table, columns):
+    # PostgreSQL's default naming, cut to the 63 byte identifier limit
+    return truncate_identifier('_'.join([table] + list(columns)), 59) + '_idx'
+
+
+class IndexBuild():
+
+    def __init__(self, tools, table, columns, name=None, unique=False, method='btree', opclass=None):
+        self.id = uuid.uuid4().hex
+        self.tools = tools
+        self.table = table
+        self.columns = columns
+        # The name PostgreSQL will really create, for the checks and cleanup below
+        self.name = truncate_identifier(name) if name else index_name(table, columns)
+        self.unique = unique
+        self.method = method
+        self.opclass = opclass
+        self.status = 'pending'
+        self.pid = None
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.thread = None
+        self._conn = None
+        self.statement = pg_sql.SQL('CREATE {}INDEX CONCURRENTLY {} ON {} USING {} ({})').format(
+            pg_sql.SQL('UNIQUE ' if unique else ''), pg_sql.Identifier(self.name), pg_sql.Identifier(table),
+            pg_sql.SQL(method), pg_sql.SQL(', ').join(
+                pg_sql.SQL('{} {}').format(pg_sql.Identifier(column), pg_sql.SQL(opclass)) if opclass
+                else pg_sql.Identifier(column) for column in columns))
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    def to_dict(self, progress=None):
+        return {
+            'id': self.id,
+            'table': self.table,
+            'name': self.name,
+            'status': self.status,
+            'pid': self.pid,
+            'elapsed': round(self.elapsed, 1),
+            'error': self.error,
+            'progress': progress,
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f'index-{self.id}', daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        conn = self._conn
+        if conn is not None:
+            conn.cancel()
+
+    def run(self):
+        self.started = time.time()
+        self.status = 'running'
+        try:
+            with self.tools.connection() as conn:
+                # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+                conn.autocommit = True
+                self._conn = conn
+                try:
+                    self.pid = conn.get_backend_pid()
+                    with conn.cursor() as cursor:
+                        # Never touch a relation this build did not create
+                        cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s "
+                                       "AND relnamespace = 'public'::regnamespace;", (self.name,))
+                        if cursor.fetchone() is not None:
+                            raise ValueError(f'A relation named "{self.name}" already exists')
+                        cursor.execute(self.statement)
+                except pg_errors.DuplicateTable:
+                    # Created by someone else since the check
+                    raise
+                except psycopg2.Error:
+                    # A failed concurrent build leaves its invalid index behind
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT NOT i.indisvalid FROM pg_index i "
+                                       "JOIN pg_class c ON c.oid = i.indexrelid "
+                                       "WHERE c.relname = %s AND c.relnamespace = 'public'::regnamespace;",
+                                       (self.name,))
+                        row = cursor.fetchone()
+                        if row is not None and row[0]:
+                            cursor.execute(pg_sql.SQL('DROP INDEX CONCURRENTLY {}').format(
+                                pg_sql.Identifier(self.name)))
+                    raise
+                finally:
+                    self._conn = None
+                    conn.autocommit = False
+            self.status = 'finished'
+        except psycopg2.extensions.QueryCanceledError:
+            self.status = 'cancelled'
+        except Exception as e:
+            print(f"Error building index {self.name}: {e}")
+            self.status = 'failed'
+            self.error = str(e)
+        finally:
+            self.finished = time.time()
+            self.tools.invalidate_schema()
+
+
+index_builds = OrderedDict()
+index_builds_lock = threading.Lock()
+
+
+def register_index_build(build):
+    with index_builds_lock:
+        index_builds[build.id] = build
+        for old_id in list(index_builds):
+            if len(index_builds) <= app.config['INDEX_HISTORY_SIZE']:
+                break
+            if index_builds[old_id].status not in ('pending', 'running'):
+                del index_builds[old_id]
+
+
+def session_tasks(registry, lock, tools):
+    with lock:
+        return [task for task in registry.values()
+                if task.tools is tools and task.status in ('pending', 'running')]
+
+
+def close_tools(tools):
+    # Cancels the session's background work and closes its connections once that has stopped
+    jobs = query_jobs.cancel_all(tools)
+    tasks = session_tasks(import_tasks, import_tasks_lock, tools) + session_tasks(index_builds, index_builds_lock, tools)
+    for task in tasks:
+        task.cancel()
+    if not jobs and not tasks:
+        tools.close()
+        return
+
+    def close_when_stopped():
+        futures_wait([job.future for job in jobs if job.future is not None])
+        for task in tasks:
+            if task.thread is not None:
+                task.thread.join()
+        tools.close()
+
+    threading.Thread(target=close_when_stopped, name='close-session', daemon=True).start()
+
+
+class SessionRegistry():
+    # A PostgresTools per browser session, under a random token kept in the session cookie
+
+    def __init__(self):
+        # token -> (tools, time last used), least recently used first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._swept = time.time()
+        self.connections = ConnectionLimit(reclaim=self.close_idle_connections)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, token):
+        with self._lock:
+            if token not in self._sessions:
+                return None
+            tools, _ = self._sessions.pop(token)
+            self._sessions[token] = (tools, time.time())
+            return tools
+
+    def add(self, token, tools):
+        with self._lock:
+            previous, _ = self._sessions.pop(token, (None, None))
+            self._sessions[token] = (tools, time.time())
+        if previous is not None:
+            close_tools(previous)
+
+    def remove(self, token):
+        with self._lock:
+            tools, _ = self._sessions.pop(token, (None, None))
+        if tools is not None:
+            close_tools(tools)
+
+    def make_room(self, max_sessions):
+        # Closes the least recently used idle sessions until one more fits
+        victims = []
+        with self._lock:
+            for token, (tools, _) in list(self._sessions.items()):
+                if not max_sessions or len(self._sessions) < max_sessions:
+                    break
+                if not tools.busy:
+                    victims.append(self._sessions.pop(token)[0])
+            fits = not max_sessions or len(self._sessions) < max_sessions
+        for tools in victims:
+            close_tools(tools)
+        return fits
+
+    def evict_idle(self, timeout, interval=60):
+        now = time.time()
+        if now - self._swept < interval:
+            return
+        self._swept = now
+        with self._lock:
+            victims = [token for token, (tools, last_used) in self._sessions.items()
+                       if now - last_used > timeout and not tools.busy]
+            victims = [self._sessions.pop(token)[0] for token in victims]
+        for tools in victims:
+            close_tools(tools)
+
+    def close_idle_connections(self):
+        with self._lock:
+            pools = [pool for tools, _ in self._sessions.values() for pool in tools.pools]
+        for pool in pools:
+            pool.close_idle()
+
+    def pool_stats(self):
+        with self._lock:
+            pools = [pool for tools, _ in self._sessions.values() for pool in tools.pools]
+        totals = {'size': 0, 'idle': 0, 'in_use': 0, 'max': 0}
+        for pool in pools:
+            for key, value in pool.stats().items():
+                totals[key] += value
+        if self.connections.limit:
+            totals['max'] = min(totals['max'], self.connections.limit)
+        return totals
+
+    def close_all(self):
+        with self._lock:
+            victims = [tools for tools, _ in self._sessions.values()]
+            self._sessions.clear()
+        for tools in victims:
+            close_tools(tools)
+
+
+sessions = SessionRegistry()
+
+
+def current_dataset():
+    # Looked up once per request; background threads are handed the object itself
+    if not has_request_context():
+        return None
+    if 'dataset' not in g:
+        token = session.get('connection')
+        g.dataset = sessions.get(token) if token else None
+    return g.dataset
+
+
+dataset = LocalProxy(current_dataset)
+
+
 def require_database(fn):
     @wraps(fn)
     def inner(table, *args, **kwargs):
-        if not database:
+        if not dataset:
             return redirect(url_for('index'))
         if table not in dataset.tables:
             abort(404)
@@ -277,17 +2770,59 @@ def require_database(fn):
     return inner
 
 
+def replica_reads(fn):
+    # GET requests of pages that only read may be served by the replica
+    @wraps(fn)
+    def inner(*args, **kwargs):
+        if dataset and request.method == 'GET':
+            dataset.read_from_replica()
+        return fn(*args, **kwargs)
+    return inner
+
+
+# Changes on every start, so ETags from an earlier run never match
+BOOT_ID = uuid.uuid4().hex
+
+
+def conditional(fn):
+    @wraps(fn)
+    def inner(*args, **kwargs):
+        # Pending flash messages are shown by the next page, so it must be rendered
+        if (not app.config['CONDITIONAL_GET'] or request.method != 'GET' or not dataset
+                or '_flashes' in session):
+            return fn(*args, **kwargs)
+        try:
+            state = dataset.table_fingerprint(request.view_args.get('table'))
+        except psycopg2.Error as e:
+            print(f"Error reading the table fingerprint: {e}")
+            dataset.db.rollback()
+            return fn(*args, **kwargs)
+        etag = hashlib.sha1(repr((BOOT_ID, dataset.id, request.endpoint, state)).encode()).hexdigest()
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(fn(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        # Weak: the same page may be sent compressed or not
+        response.set_etag(etag, weak=True)
+        response.cache_control.no_cache = True
+        return response
+    return inner
+
 
 @app.route('/', methods=('GET', 'POST'))
+@conditional
 def index():
-    global database
-    database = "<FileStorage: 'example.db' ('application/octet-stream')>"
     if not dataset:
         if request.method == 'POST':
             port = request.form.get('port')
             if int(port) < 0:
                 flash(f'Error logging in. Invalid port value', 'danger')
                 return render_template('index.html')
+            if not sessions.make_room(app.config['MAX_SESSIONS']):
+                flash('Error logging in. Too many open sessions, try again later.', 'danger')
+                return render_template('index.html')
             dbname = request.form.get('dbname')
             user = request.form.get('username')
             password = request.form.get('password')
@@ -302,14 +2837,142 @@ def index():
 @app.route('/<table>', methods=('GET', 'POST'))
 @require_database
 def table_info(table):
+    # Not conditional: index usage counters and running builds change without any write
     return render_template(
         'table_structure.html',
-        columns=dataset.get_table(table),
+        row_count=dataset.row_count(table, exact=request.args.get('exact', type=parse_flag)),
         infos=dataset.get_table_info(table),
         table=table,
-        # indexes=dataset.get_indexes(table),
-        # foreign_keys=dataset.get_foreign_keys(table),
-        table_sql=dataset.table_sql(table))
+        indexes=dataset.get_indexes(table),
+        foreign_keys=dataset.get_foreign_keys(table),
+        index_builds=[build for build in session_tasks(index_builds, index_builds_lock, dataset._get_current_object())
+                      if build.table == table])
+
+
+@app.route('/<table>/profile', methods=['GET', 'POST'])
+@replica_reads
+@require_database
+@conditional
+def table_profile(table):
+    if request.method == 'POST':
+        try:
+            dataset.analyze(table, app.config['PROFILE_STATISTICS_TARGET'])
+            flash('The statistics were refreshed.', 'success')
+        except psycopg2.Error as e:
+            dataset.db.rollback()
+            flash(f'Error analyzing the table: {e}', 'danger')
+        return redirect(url_for('table_profile', table=table))
+    return render_template(
+        'table_profile.html',
+        profiles=dataset.column_profile(table),
+        row_count=dataset.row_count(table),
+        table=table)
+
+
+@app.route('/<table>/preview')
+@replica_reads
+@require_database
+def table_preview(table):
+    seed = request.args.get('seed', type=int)
+    try:
+        description, rows, percent = dataset.preview(table, app.config['PREVIEW_ROWS'], seed=seed)
+    except psycopg2.Error as e:
+        dataset.db.rollback()
+        flash(f'Error sampling the table: {e}', 'danger')
+        return redirect(url_for('table_profile', table=table))
+    return render_template(
+        'table_preview.html',
+        description=description,
+        rows=rows,
+        percent=percent,
+        seed=seed,
+        next_seed=int(time.time() * 1000) % 2147483647,
+        table=table)
+
+
+@app.route('/<table>/add-index', methods=['GET', 'POST'])
+@require_database
+def add_index(table):
+    columns = dataset.get_table_info(table)
+    column_names = [column.name for column in columns]
+    source = request.form if request.method == 'POST' else request.args
+    indexed_columns = [name for name in source.getlist('indexed_columns') if name in column_names]
+    unique = bool(source.get('unique'))
+    method = source.get('method', 'btree')
+    opclass = source.get('opclass', '').strip()
+    name = source.get('name', '').strip()
+
+    if request.method == 'POST':
+        if not indexed_columns:
+            flash('Select at least one column.', 'danger')
+        elif method not in app.config['INDEX_METHODS']:
+            flash(f'Unknown index method "{method}".', 'danger')
+        elif opclass and not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?', opclass):
+            flash(f'"{opclass}" is not an operator class name.', 'danger')
+        else:
+            build = IndexBuild(dataset._get_current_object(), table, indexed_columns, name=name or None, unique=unique,
+                               method=method, opclass=opclass or None)
+            register_index_build(build)
+            build.start()
+            return redirect(url_for('index_build_progress', table=table, build_id=build.id))
+
+    return render_template(
+        'add_index.html',
+        columns=columns,
+        indexed_columns=indexed_columns,
+        unique=unique,
+        method=method,
+        methods=app.config['INDEX_METHODS'],
+        opclass=opclass,
+        name=name,
+        table=table)
+
+
+def get_index_build(build_id):
+    # Builds are only visible to the session that started them
+    build = index_builds.get(build_id)
+    if build is None or build.tools is not dataset._get_current_object():
+        abort(404)
+    return build
+
+
+@app.route('/<table>/indexes/<build_id>')
+@require_database
+def index_build_progress(table, build_id):
+    build = get_index_build(build_id)
+    if build.table != table:
+        abort(404)
+    return render_template('index_build.html', build=build, table=table)
+
+
+@app.route('/_/index-builds/<build_id>')
+def index_build_status(build_id):
+    build = get_index_build(build_id)
+    progress = None
+    if build.status == 'running' and build.pid:
+        progress = build.tools.index_build_progress(build.pid)
+    return jsonify(build.to_dict(progress))
+
+
+@app.route('/_/index-builds/<build_id>/cancel', methods=['POST'])
+def index_build_cancel(build_id):
+    build = get_index_build(build_id)
+    build.cancel()
+    return redirect(request.referrer or url_for('index'))
+
+
+@app.route('/<table>/drop-index', methods=['POST'])
+@require_database
+def drop_index(table):
+    name = request.form.get('name', '')
+    if name not in [index.name for index in dataset.get_indexes(table)]:
+        abort(404)
+    try:
+        dataset.drop_index(name)
+        flash(f'The index "{name}" was dropped.', 'success')
+    except psycopg2.Error as e:
+        flash(f'Error dropping the index: {e}', 'danger')
+    return redirect(url_for('table_info', table=table))
 
 
 @app.route('/<table>/rename-column', methods=['GET', 'POST'])
@@ -317,7 +2980,7 @@ def table_info(table):
 def rename_column(table):
     rename = request.args.get('rename')
     infos = dataset.get_table_info(table)
-    column_names = [row[0] for row in infos]
+    column_names = [column.name for column in infos]
     if request.method == 'POST':
         new_name = request.form.get('rename_to', '')
         rename = request.form.get('rename', '')
@@ -325,8 +2988,10 @@ def rename_column(table):
             try:
                 dataset.cursor.execute(f'ALTER TABLE {table} RENAME COLUMN {rename} TO {new_name}')
                 dataset.db.commit()
+                dataset.invalidate_schema()
                 flash(f'The column "{rename}" has been successfully renamed to "{new_name}"!', 'success')
             except Exception as e:
+                dataset.db.rollback()
                 flash(f'Error when renaming a column: {e}', 'danger')
         else:
             flash('The column name must not be empty or match another one', 'danger')
@@ -390,65 +3055,132 @@ def add_row(table, edit):
     if request.method == 'POST':
         values = {}
         for column_info in dataset.get_table_info(table):
-            column_name = column_info[0]
+            column_name = column_info.name
             values[column_name] = None if request.form.get(column_name) == '' else request.form.get(column_name)
         dataset.add_row(table, values)
     return redirect(url_for('table_content', table=table, edit=edit))
 
 
-@app.route('/apply_changes', methods=['POST'])
-def apply_changes():
-    table = request.form.get('table_name')
-    name = request.form.get('columnLabel').strip()
-    row = int(request.form.get('rowLabel'))
-    new_value = request.form.get('newValue')
+@app.route('/<table>/apply-changes', methods=['POST'])
+@require_database
+def apply_changes(table):
+    changes = (request.get_json(silent=True) or {}).get('changes')
+    if not isinstance(changes, list):
+        return jsonify({'error': 'Expected a JSON object with a list of changes'}), 400
     try:
-        sql = f"UPDATE {table} SET {name} = '{new_value}' WHERE id = {row}"
-        dataset.update_cell(sql)
-
-        return jsonify({'message': 'The data has been successfully updated in the database.'})
+        results = dataset.update_cells(table, changes)
     except Exception as e:
-        return jsonify({'error': str(e)})
+        dataset.db.rollback()
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'results': results})
 
 @app.route('/<table>/<edit>/delete-row/', methods=['POST'])
 @require_database
 def delete_row(table, edit):
-    row_id = eval(request.form.get('row_id'))
     try:
-        columns_info = dataset.get_table_info(table)
-        sql = f"DELETE FROM {table} WHERE "
-        new_mass = []
-        for names in columns_info:
-            new_mass.append(names[0])
-        for i in range(len(new_mass)):
-            if row_id[i] != None:
-                sql += f"{new_mass[i]} = '{row_id[i]}' AND "
-        sql = sql[:-5]
-        dataset.cursor.execute(sql)
-        dataset.db.commit()
-        flash('The row was successfully deleted.', 'success')
+        keys = [json.loads(key) for key in request.form.getlist('row_key')]
+        if not keys:
+            flash('No rows are selected.', 'danger')
+        else:
+            deleted = dataset.delete_rows(table, keys)
+            if deleted == 1:
+                flash('The row was successfully deleted.', 'success')
+            else:
+                flash(f'{deleted} rows were successfully deleted.', 'success')
     except Exception as e:
+        dataset.db.rollback()
         flash(f'Error deleting a row: {e}', 'danger')
-    return redirect(url_for('table_content', table=table, edit=edit))
+    return redirect(request.referrer or url_for('table_content', table=table, edit=edit))
+
+
+def request_filters(infos):
+    # Filters arrive as f.<column>=<expression> and search as q=<text>
+    filters = {column.name: request.args[f'f.{column.name}'] for column in infos
+               if request.args.get(f'f.{column.name}', '').strip()}
+    search = request.args.get('q', '').strip()
+    filter_args = {f'f.{name}': expression for name, expression in filters.items()}
+    if search:
+        filter_args['q'] = search
+    predicates = [parse_filter(column, filters[column.name]) for column in infos if column.name in filters]
+    searchable = True
+    if search:
+        predicate = search_predicate(infos, search)
+        searchable = predicate is not None
+        if searchable:
+            predicates.append(predicate)
+    return filters, search, filter_args, predicates, searchable
+
+
+def fetch_rows(table, infos, paginate_by, ordering, page, after, before, where):
+    # Seek from a cursor when we have one, OFFSET only for bookmarked deep pages
+    # and tables without a unique ordering. Returns the rows, their keys and the
+    # keyset Page or None when OFFSET was used
+    key_positions = [position for position, column in enumerate(infos) if column.primary_key]
+    keyset_page = None
+    if after or before or page <= 1:
+        keyset_page = dataset.paginate_keyset(
+            table, paginate_by=paginate_by, order=ordering, after=after, before=before, where=where)
+    if keyset_page is not None:
+        rows = keyset_page.rows
+    else:
+        rows = dataset.paginate(
+            table, page, paginate_by=paginate_by, order=ordering, with_row_id=not key_positions, where=where)
+    rows = rows or []
+    if key_positions:
+        row_keys = [[copy_value(row[position]) for position in key_positions] for row in rows]
+    else:
+        row_keys = [list(row[-2:]) for row in rows]
+        rows = [row[:-2] for row in rows]
+    return rows, row_keys, keyset_page
 
 
 @app.route('/<table>/<edit>/content', methods=['GET', 'POST'])
+@replica_reads
 @require_database
+@conditional
 def table_content(table, edit):
-    columns_count = dataset.get_table(table)
+    exact = request.args.get('exact', type=parse_flag)
+    infos = dataset.get_table_info(table)
     ordering = request.args.get('ordering')
     rows_per_page = app.config['ROWS_PER_PAGE']
     page = request.args.get('page', 1, type=int)
-    if ordering:
-        columns = dataset.paginate(
-            table, page, paginate_by=rows_per_page, order=ordering)
+    after = request.args.get('after')
+    before = request.args.get('before')
+
+    filters, search, filter_args, predicates, searchable = request_filters(infos)
+    if not searchable:
+        flash('The table has no text columns to search.', 'danger')
+    where = combine_predicates(predicates)
+    hints = []
+    if where:
+        try:
+            row_count, seq_scan = dataset.filtered_row_count(table, where, exact=exact)
+        except psycopg2.Error as e:
+            flash(f'Error in the filter: {e}', 'danger')
+            # Keep the filters on screen for fixing, but show no rows
+            row_count, seq_scan, where = RowCount(0, False), False, (pg_sql.SQL('FALSE'), [])
+        if seq_scan and dataset.row_count(table).count >= app.config['FILTER_HINT_MIN_ROWS']:
+            hints = index_hints(table, predicates, dataset.table_schema(table).indexes)
     else:
-        columns = dataset.paginate(
-            table=table, page=page, paginate_by=rows_per_page)
-    total_pages = (len(columns_count) // rows_per_page) + 1
-    previous_page = page - 1
-    next_page = page + 1 if page + \
-        1 <= total_pages else 0
+        row_count = dataset.row_count(table, exact=exact)
+    total_pages = max(1, math.ceil(row_count.count / rows_per_page))
+
+    columns, row_keys = [], []
+    next_cursor, previous_cursor, previous_page, next_page = None, None, 0, 0
+    # Browsing loads rows from table_rows as the grid scrolls
+    if edit != 'view':
+        columns, row_keys, keyset_page = fetch_rows(
+            table, infos, rows_per_page, ordering, page, after, before, where)
+        if keyset_page is not None:
+            next_cursor, previous_cursor = keyset_page.next_cursor, keyset_page.previous_cursor
+            previous_page = max(page - 1, 1) if previous_cursor else 0
+            next_page = page + 1 if next_cursor else 0
+        else:
+            previous_page = page - 1
+            # An estimate can be short of the real count, so a full page always offers a next one
+            has_next = page < total_pages or (row_count.estimated and len(columns) == rows_per_page)
+            next_page = page + 1 if has_next else 0
+
     return render_template(
         'table_content.html',
         columns=columns,
@@ -457,30 +3189,212 @@ def table_content(table, edit):
         total_pages=total_pages,
         previous_page=previous_page,
         next_page=next_page,
-        columns_count=columns_count,
-        infos=dataset.get_table_info(table),
+        previous_cursor=previous_cursor,
+        next_cursor=next_cursor,
+        row_count=row_count,
+        row_keys=row_keys,
+        infos=infos,
+        filters=filters,
+        search=search,
+        filter_args=filter_args,
+        hints=hints,
+        rows_limit=app.config['ROWS_API_LIMIT'],
         table=table,
         edit=edit
     )
 
 
+def json_value(value):
+    if value is None or isinstance(value, (str, bool, int)):
+        return value
+    if isinstance(value, float) and math.isfinite(value):
+        return value
+    # Shown the way the HTML grid shows it
+    return str(value)
+
+
+@app.route('/<table>/rows')
+@replica_reads
+@require_database
+@conditional
+def table_rows(table):
+    # Column-oriented rows for the grid and API clients: data[i] holds the values of columns[i]
+    infos = dataset.get_table_info(table)
+    limit = min(max(request.args.get('limit', app.config['ROWS_API_LIMIT'], type=int), 1),
+                app.config['ROWS_API_MAX'])
+    page = request.args.get('page', 1, type=int)
+    _, _, _, predicates, searchable = request_filters(infos)
+    if not searchable:
+        return jsonify({'error': 'The table has no text columns to search'}), 400
+    where = combine_predicates(predicates)
+    after, before = request.args.get('after'), request.args.get('before')
+    row_count = None
+    try:
+        # The first window also reports the row count, unless the caller has it already (count=0)
+        if not after and not before and page <= 1 and request.args.get('count', True, type=parse_flag):
+            row_count = dataset.filtered_row_count(table, where)[0] if where else dataset.row_count(table)
+        rows, row_keys, keyset_page = fetch_rows(
+            table, infos, limit, request.args.get('ordering'), page, after, before, where)
+    except psycopg2.Error as e:
+        return jsonify({'error': str(e)}), 400
+
+    if keyset_page is not None:
+        next_page = {'after': keyset_page.next_cursor} if keyset_page.next_cursor else None
+    else:
+        next_page = {'page': page + 1} if len(rows) == limit else None
+    payload = {
+        'columns': [column.name for column in infos],
+        'types': [column.data_type for column in infos],
+        'rows': len(rows),
+        'data': [[json_value(row[position]) for row in rows] for position in range(len(infos))],
+        'keys': row_keys,
+        'next': next_page,
+    }
+    if row_count is not None:
+        payload['count'] = row_count.count
+        payload['estimated'] = row_count.estimated
+    if request.args.get('format') == 'msgpack' or \
+            request.accept_mimetypes.best == 'application/msgpack':
+        if msgpack is None:
+            return jsonify({'error': 'MessagePack needs the msgpack package'}), 406
+        return Response(msgpack.packb(payload, use_bin_type=True), mimetype='application/msgpack')
+    return jsonify(payload)
+
+
+def export_response(chunks, name, fmt, compress):
+    # Wait for the first chunk so that a failing COPY is still reported as an error
+    try:
+        first = next(chunks, b'')
+    except psycopg2.Error as e:
+        flash(f'Error exporting data: {e}', 'danger')
+        return redirect(request.referrer or url_for('index'))
+    chunks = itertools.chain([first], chunks)
+    mimetype, extension, _ = EXPORT_FORMATS[fmt]
+    filename = f'{name}.{extension}'
+    if compress:
+        chunks = gzip_stream(chunks)
+        mimetype = 'application/gzip'
+        filename += '.gz'
+    return Response(chunks, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@app.route('/<table>/export/<fmt>')
+@replica_reads
+@require_database
+def export_table(table, fmt):
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    return export_response(dataset.export_table(table, fmt), table, fmt, request.args.get('gzip', type=parse_flag))
+
+
+@app.route('/<table>/query/export', methods=['GET', 'POST'])
+@require_database
+def export_query(table):
+    sql = request.values.get('sql', '')
+    fmt = request.values.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    if not is_read_query(sql):
+        flash('Only a single SELECT, WITH, VALUES or TABLE statement can be exported', 'danger')
+        return redirect(url_for('table_query', table=table, sql=sql))
+    return export_response(dataset.export_query(sql, fmt), f'{table}-query', fmt,
+                           request.values.get('gzip', type=parse_flag))
+
+
+@app.route('/<table>/import/', methods=['GET', 'POST'])
+@require_database
+def import_rows(table):
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Choose a file to import', 'danger')
+            return redirect(url_for('import_rows', table=table))
+        fmt = request.form.get('format') or ('jsonl' if upload.filename.lower().endswith(('.jsonl', '.json', '.ndjson')) else 'csv')
+        if fmt not in ('csv', 'jsonl'):
+            flash('The file format must be CSV or JSON Lines', 'danger')
+            return redirect(url_for('import_rows', table=table))
+        commit_mode = 'single' if request.form.get('commit_mode') == 'single' else 'batch'
+        batch_size = request.form.get('batch_size', app.config['IMPORT_BATCH_SIZE'], type=int)
+        # The upload is copied to disk in chunks, never held in memory
+        fd, path = tempfile.mkstemp(prefix='import-', suffix='.' + fmt)
+        with os.fdopen(fd, 'wb') as file:
+            upload.save(file)
+        task = ImportTask(dataset._get_current_object(), table, path, fmt, commit_mode, max(batch_size, 1))
+        register_import(task)
+        task.start()
+        return redirect(url_for('import_progress', table=table, task_id=task.id))
+    return render_template('import_rows.html', table=table, batch_size=app.config['IMPORT_BATCH_SIZE'])
+
+
+def get_import(task_id):
+    # Imports are only visible to the session that started them
+    task = import_tasks.get(task_id)
+    if task is None or task.tools is not dataset._get_current_object():
+        abort(404)
+    return task
+
+
+@app.route('/<table>/import/<task_id>')
+@require_database
+def import_progress(table, task_id):
+    task = get_import(task_id)
+    if task.table != table:
+        abort(404)
+    return render_template('import_progress.html', table=table, task=task)
+
+
+@app.route('/_/imports/<task_id>')
+def import_status(task_id):
+    task = get_import(task_id)
+    return jsonify(task.to_dict())
+
+
+@app.route('/_/imports/<task_id>/errors')
+def import_errors(task_id):
+    task = get_import(task_id)
+    if not task.error_path or task.status == 'running':
+        abort(404)
+    response = send_file(task.error_path, mimetype='text/csv', as_attachment=True,
+                         download_name=f'{task.table}-rejected.csv', max_age=0)
+    response.cache_control.private = True
+    return response
+
+
 @app.route('/<table>/query/', methods=['GET', 'POST'])
 @require_database
 def table_query(table):
-    row_count, error, data, data_description = None, None, None, None
-    cursor = dataset.db.cursor()
+    row_count, error, message, data, data_description, has_more = None, None, None, None, None, False
+    profile, analyze, rollback = None, True, True
 
-    if request.method == 'POST':
+    if request.method == 'POST' and request.form.get('mode') == 'profile':
         sql = request.form.get('sql', '')
+        analyze = bool(request.form.get('analyze'))
+        rollback = bool(request.form.get('rollback'))
+        started = time.perf_counter()
         try:
-            cursor.execute(sql)
-            dataset.db.commit()
-            data = cursor.fetchall()[:app.config['MAX_RESULT_SIZE']]
-            data_description = cursor.description
-            row_count = len(data)
+            profile = profile_plan(
+                dataset.explain(sql, analyze=analyze, rollback=rollback, timeout=app.config['QUERY_TIMEOUT']),
+                hot_nodes=app.config['PLAN_HOT_NODES'], hot_share=app.config['PLAN_HOT_SHARE'])
+        except Exception as exc:
+            error = str(exc)
+        query_history.add(dataset.location, 'explain', sql, time.perf_counter() - started, error=error)
+    elif request.method == 'POST':
+        sql = request.form.get('sql', '')
+        started = time.perf_counter()
+        try:
+            data_description, data, row_count, has_more = dataset.execute_query(
+                sql, app.config['MAX_RESULT_SIZE'], timeout=app.config['QUERY_TIMEOUT'],
+                max_bytes=app.config['MAX_RESULT_BYTES'], fetch_size=app.config['QUERY_FETCH_SIZE'])
+            if not is_read_query(sql):
+                dataset.invalidate_row_count()
+                dataset.invalidate_schema()
+            if data_description is None:
+                message = "Success!"
         except Exception as exc:
+            dataset.db.rollback()
             error = str(exc)
-            if error == "no results to fetch": error = "Success!"
+        query_history.add(dataset.location, 'console', sql, time.perf_counter() - started, row_count, error)
     else:
         if request.args.get('sql'):
             sql = request.args.get('sql')
@@ -492,13 +3406,172 @@ def table_query(table):
         row_count=row_count,
         data=data,
         data_description=data_description,
+        has_more=has_more,
+        streamable=is_read_query(sql),
+        profile=profile,
+        analyze=analyze,
+        rollback=rollback,
         table=table,
         sql=sql,
         error=error,
-        table_sql=dataset.table_sql(table)
+        message=message
     )
 
 
+@app.route('/<table>/query/history')
+@require_database
+def table_query_history(table):
+    view = request.args.get('view')
+    selected = request.args.get('fingerprint')
+    entries, statements, server = [], [], None
+    if view in ('slowest', 'frequent'):
+        limit = app.config['HISTORY_TOP']
+        statements = query_history.top(dataset.location, view, limit)
+        try:
+            # Far more than shown, so that most local statements find their match
+            server_stats = dataset.statement_stats(limit * 50)
+        except psycopg2.Error as e:
+            dataset.db.rollback()
+            flash(f'Error reading pg_stat_statements: {e}', 'danger')
+            server_stats = None
+        if server_stats is not None:
+            statements, server = merge_statement_stats(statements, server_stats, view, limit)
+    else:
+        view = 'recent'
+        entries = query_history.recent(dataset.location, app.config['HISTORY_PAGE_SIZE'], selected)
+    return render_template(
+        'table_query_history.html',
+        view=view,
+        selected=selected,
+        entries=entries,
+        statements=statements,
+        server=server,
+        table=table)
+
+
+@app.route('/<table>/query/plans', methods=['GET', 'POST'])
+@require_database
+def table_plans(table):
+    directory = app.config['PLAN_DIRECTORY']
+    if request.method == 'POST':
+        try:
+            plan = json.loads(request.form.get('plan', ''))
+            save_plan(directory, dataset.location, table, request.form.get('sql', ''),
+                      request.form.get('name', '').strip(), plan)
+            flash('The plan was saved.', 'success')
+        except (ValueError, OSError) as e:
+            flash(f'Error saving the plan: {e}', 'danger')
+        return redirect(url_for('table_plans', table=table))
+    return render_template('table_plans.html', plans=list_plans(directory, dataset.location, table), table=table)
+
+
+@app.route('/<table>/query/plans/diff')
+@require_database
+def table_plans_diff(table):
+    directory = app.config['PLAN_DIRECTORY']
+    before = load_plan(directory, dataset.location, request.args.get('before'))
+    after = load_plan(directory, dataset.location, request.args.get('after'))
+    if before is None or after is None:
+        flash('Select two saved plans to compare.', 'danger')
+        return redirect(url_for('table_plans', table=table))
+    profiles = [profile_plan(saved['plan'], hot_nodes=app.config['PLAN_HOT_NODES'],
+                             hot_share=app.config['PLAN_HOT_SHARE']) for saved in (before, after)]
+    deltas, diff = compare_plans(*profiles)
+    return render_template('table_plans_diff.html', before=before, after=after, profiles=profiles,
+                           deltas=deltas, diff=diff, table=table)
+
+
+@app.route('/<table>/query/stream')
+@require_database
+def table_query_stream(table):
+    sql = request.args.get('sql', '')
+    if not is_read_query(sql):
+        flash('Only a single SELECT, WITH, VALUES or TABLE statement can be streamed', 'danger')
+        return redirect(url_for('table_query', table=table, sql=sql))
+    location = dataset.location
+    started = time.perf_counter()
+    try:
+        description, rows = dataset.stream_query(
+            sql, timeout=app.config['QUERY_TIMEOUT'], fetch_size=app.config['QUERY_FETCH_SIZE'])
+    except Exception as exc:
+        query_history.add(location, 'stream', sql, time.perf_counter() - started, error=str(exc))
+        flash(f'Error executing the query: {exc}', 'danger')
+        return redirect(url_for('table_query', table=table, sql=sql))
+
+    # Errors after the first rows can only be reported at the end of the page
+    state = {'error': None}
+
+    def guarded_rows():
+        count = 0
+        try:
+            for count, row in enumerate(rows, 1):
+                yield row
+        except psycopg2.Error as exc:
+            state['error'] = str(exc)
+        query_history.add(location, 'stream', sql, time.perf_counter() - started, count, state['error'])
+
+    context = {'table': table, 'sql': sql, 'data_description': description,
+               'rows': guarded_rows(), 'state': state}
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template('table_query_stream.html').stream(context)
+    stream.enable_buffering(100)
+    return Response(stream_with_context(stream))
+
+
+
+@app.route('/<table>/query/jobs', methods=['POST'])
+@require_database
+def table_query_job_submit(table):
+    sql = request.form.get('sql', '')
+    if not sql.strip():
+        flash('Enter a query.', 'danger')
+        return redirect(url_for('table_query', table=table))
+    job = QueryJob(dataset._get_current_object(), table, sql, timeout=app.config['JOB_TIMEOUT'],
+                   max_rows=app.config['JOB_MAX_ROWS'], fetch_size=app.config['QUERY_FETCH_SIZE'])
+    query_jobs.submit(job, workers=app.config['JOB_WORKERS'], result_ttl=app.config['JOB_RESULT_TTL'],
+                      history_size=app.config['JOB_HISTORY_SIZE'])
+    return redirect(url_for('table_query_job', table=table, job_id=job.id))
+
+
+def get_job(job_id):
+    job = query_jobs.get(job_id, result_ttl=app.config['JOB_RESULT_TTL'],
+                         history_size=app.config['JOB_HISTORY_SIZE'])
+    # Jobs are only visible to the session that submitted them
+    if job is None or job.tools is not dataset._get_current_object():
+        abort(404)
+    return job
+
+
+@app.route('/<table>/query/jobs/<job_id>')
+@require_database
+def table_query_job(table, job_id):
+    job = get_job(job_id)
+    rows_per_page = app.config['MAX_RESULT_SIZE']
+    page = max(request.args.get('page', 1, type=int), 1)
+    total_pages = max(1, math.ceil(len(job.rows) / rows_per_page)) if job.status == 'finished' else 1
+    return render_template(
+        'table_query_job.html',
+        job=job,
+        rows=job.page(page, rows_per_page) if job.status == 'finished' else [],
+        page=page,
+        total_pages=total_pages,
+        table=table,
+    )
+
+
+# App routes live under /_/ so that no table name can shadow them
+@app.route('/_/jobs/<job_id>')
+def query_job_status(job_id):
+    return jsonify(get_job(job_id).to_dict())
+
+
+@app.route('/_/jobs/<job_id>/cancel', methods=['POST'])
+def query_job_cancel(job_id):
+    job = get_job(job_id)
+    if not job.done:
+        job.cancel()
+    return redirect(request.referrer or url_for('index'))
+
 
 @app.route('/table_create/', methods=['POST'])
 def table_create():
@@ -509,8 +3582,10 @@ def table_create():
     try:
         dataset.cursor.execute(f'CREATE TABLE {table}(id SERIAL PRIMARY KEY)')
         dataset.db.commit()
+        dataset.invalidate_schema()
         return redirect(url_for('table_info', table=table))
     except Exception as e:
+        dataset.db.rollback()
         flash(f'Error creating the table: {str(e)}', 'danger')
         return redirect(request.referrer)
 
@@ -520,9 +3595,10 @@ def table_create():
 def delete_table(table):
     if request.method == 'POST':
         try:
-            dataset.cursor.execute('DROP TABLE %s' % table)
-            dataset.db.commit()
+            dataset.delete_table(table)
+            dataset.invalidate_row_count(table)
         except Exception as exc:
+            dataset.db.rollback()
             flash('Error deleting the table: %s' % exc, 'danger')
         else:
             flash('The table "%s" was successfully deleted.' % table, 'success')
@@ -532,10 +3608,11 @@ def delete_table(table):
 
 @app.route('/close')
 def close():
-    global database
-    global dataset
-    dataset = None
-    database = None
+    # Only this browser's session; other sessions keep their connections
+    token = session.pop('connection', None)
+    if token:
+        sessions.remove(token)
+    g.dataset = None
     return redirect(url_for('index'))
 
 
@@ -561,20 +3638,167 @@ def format_create_table(sql):
         return sql
 
 
+@app.template_filter()
+def row_count_label(row_count):
+    if row_count is None:
+        return ''
+    label = '{:,} rows'.format(row_count.count)
+    return '\u2248 ' + label if row_count.estimated else label
+
+
+@app.template_filter()
+def datetimeformat(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
 @app.template_filter('highlight')
 def highlight_filter(data):
     return Markup(syntax_highlight(data))
 
 
+ddl_cache = LRUCache(DDL_CACHE_SIZE)
+
+
+@app.template_filter()
+def table_ddl(table):
+    # Formatted and highlighted CREATE TABLE; a schema change bumps the version and so the key
+    key = (dataset.id, table, dataset.schema_version)
+    return ddl_cache.get(key, lambda: Markup(syntax_highlight(format_create_table(dataset.table_sql(table)))))
+
+
+@app.teardown_request
+def _release_connection(exc):
+    if dataset:
+        dataset.release()
+
+
+# Registered before the instrumentation hook, so it runs after the debug footer is added
+@app.after_request
+def _compress(response):
+    if response.mimetype not in app.config['COMPRESS_MIMETYPES'] or response.direct_passthrough:
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.is_streamed or 'Content-Encoding' in response.headers
+            or (response.content_length or 0) < app.config['COMPRESS_MIN_SIZE']):
+        return response
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br'] and accepted['br'] >= accepted['gzip']:
+        response.set_data(brotli.compress(response.get_data(), quality=app.config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=app.config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+@app.url_defaults
+def _static_version(endpoint, values):
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        try:
+            values['v'] = int(os.path.getmtime(os.path.join(app.static_folder, values['filename'])))
+        except OSError:
+            pass
+
+
+@app.before_request
+def _evict_idle_sessions():
+    sessions.evict_idle(app.config['SESSION_IDLE_TIMEOUT'])
+
+
+@app.before_request
+def _start_instrumentation():
+    g.queries = []
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def _finish_instrumentation(response):
+    if 'queries' not in g:
+        return response
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe_request(route, request.method, time.perf_counter() - g.started, len(g.queries))
+    if (app.config['DEBUG_FOOTER'] and response.mimetype == 'text/html' and not response.is_streamed
+            and not response.direct_passthrough and request.endpoint != 'static'):
+        body = response.get_data(as_text=True)
+        position = body.rfind('</body>')
+        if position != -1:
+            footer = render_template('debug_footer.html', queries=g.queries, **query_summary(
+                g.queries, app.config['N_PLUS_ONE_THRESHOLD']))
+            response.set_data(body[:position] + footer + body[position:])
+    return response
+
+
+def query_summary(queries, threshold):
+    groups = OrderedDict()
+    for record in queries:
+        count, duration = groups.get(record.fingerprint, (0, 0))
+        groups[record.fingerprint] = (count + 1, duration + record.duration)
+    repeated = [(fingerprint, count, duration) for fingerprint, (count, duration) in groups.items()
+                if count >= threshold]
+    return {'total_time': sum(record.duration for record in queries), 'repeated': repeated,
+            'elapsed': time.perf_counter() - g.started}
+
+
+@app.route('/_/metrics')
+def prometheus_metrics():
+    pool_stats = sessions.pool_stats() if len(sessions) else None
+    return Response(metrics.render(pool_stats), mimetype='text/plain; version=0.0.4')
+
+
 @app.context_processor
 def _general():
     return {
-        'dataset': dataset,
+        'dataset': current_dataset(),
     }
 
+def replica_address(host, port):
+    replica = app.config['REPLICAS'].get(f'{host}:{port}')
+    if not replica:
+        return None
+    replica_host, _, replica_port = replica.rpartition(':')
+    return replica_host, int(replica_port)
+
+
 def join(dbname, user, password, host, port):
-    global dataset
-    dataset = PostgresTools(dbname, user, password, host, port)
+    # Opens the database for the current browser session, replacing the one it had
+    sessions.connections.limit = app.config['MAX_CONNECTIONS']
+    tools = PostgresTools(dbname, user, password, host, port,
+                          exact_count_threshold=app.config['EXACT_COUNT_THRESHOLD'],
+                          row_count_ttl=app.config['ROW_COUNT_CACHE_TTL'],
+                          pool_min_size=app.config['POOL_MIN_SIZE'],
+                          pool_max_size=app.config['POOL_MAX_SIZE'],
+                          pool_timeout=app.config['POOL_TIMEOUT'],
+                          pool_idle_timeout=app.config['POOL_IDLE_TIMEOUT'],
+                          pool_health_check_interval=app.config['POOL_HEALTH_CHECK_INTERVAL'],
+                          schema_notify_channel=app.config['SCHEMA_NOTIFY_CHANNEL'],
+                          connection_limit=sessions.connections,
+                          replica=replica_address(host, port),
+                          replica_max_lag=app.config['REPLICA_MAX_LAG'],
+                          replica_lag_check_interval=app.config['REPLICA_LAG_CHECK_INTERVAL'],
+                          replica_sticky_seconds=app.config['REPLICA_STICKY_SECONDS'])
+    token = session.get('connection') or uuid.uuid4().hex
+    sessions.add(token, tools)
+    session['connection'] = token
+    g.dataset = tools
+    return tools
+
+
+@app.cli.command('install-schema-trigger')
+@click.option('--dbname', required=True)
+@click.option('--user', required=True)
+@click.option('--password', prompt=True, hide_input=True)
+@click.option('--host', default='localhost')
+@click.option('--port', default=5432)
+@click.option('--channel', default=lambda: app.config['SCHEMA_NOTIFY_CHANNEL'] or 'pgweb_schema')
+def install_schema_trigger(dbname, user, password, host, port, channel):
+    # Needs superuser rights, like every event trigger
+    tools = PostgresTools(dbname, user, password, host, port)
+    try:
+        tools.install_schema_event_trigger(channel)
+    finally:
+        tools.close()
+    click.echo(f'Schema changes are now announced on channel "{channel}", '
+               f'set SCHEMA_NOTIFY_CHANNEL = {channel!r} to use them.')
 
 # @app.before_request
 # def _before_request():
@@ -589,8 +3813,6 @@ def join(dbname, user, password, host, port):
 #         # dataset = PostgresTools(dbname, user, password, host, port)
 
 def main():
-    global database
-    database = None
     app.run()
 
 if __name__ == '__main__':
@@ -1,36 +1,89 @@
 $(function() {
+  // Edits are queued and sent together, in one transaction per batch
+  var BATCH_SIZE = 100;
+  var FLUSH_DELAY = 1000;
+  var changesUrl = $('#your_table').data('changesUrl');
+  var queue = [];
+  var timer = null;
 
-  $('table td').on('click', function() {
-    $(this).attr('contenteditable', true).focus();
+  function payload(batch) {
+    // The row key is read when the batch is sent: an earlier save may have moved the row
+    return JSON.stringify({changes: $.map(batch, function(edit) {
+      return $.extend({pk: edit.cell.parent().data('pk')}, edit.change);
+    })});
+  }
+
+  function flush() {
+    clearTimeout(timer);
+    timer = null;
+    if (!queue.length) {
+      return;
+    }
+    var batch = queue.splice(0, queue.length);
+    $.ajax({
+      type: 'POST',
+      url: changesUrl,
+      contentType: 'application/json',
+      data: payload(batch),
+      success: function(response) {
+        $.each(response.results, function(i, result) {
+          var cell = batch[i].cell;
+          if (result.ok) {
+            if (result.pk) {
+              cell.parent().data('pk', result.pk);
+            }
+            cell.removeClass('cell-error').addClass('cell-saved').removeAttr('title');
+          } else {
+            cell.removeClass('cell-saved').addClass('cell-error').attr('title', result.error);
+          }
+        });
+      },
+      error: function(error) {
+        $.each(batch, function(i, edit) {
+          edit.cell.removeClass('cell-saved').addClass('cell-error').attr('title', 'The change was not saved');
+        });
+        console.error('Произошла ошибка при отправке данных на сервер:', error);
+      }
+    });
+  }
+
+  function enqueue(cell, change) {
+    queue.push({cell: cell, change: change});
+    if (queue.length >= BATCH_SIZE) {
+      flush();
+    } else if (!timer) {
+      timer = setTimeout(flush, FLUSH_DELAY);
+    }
+  }
+
+  $('table td.cell[contenteditable]').on('focusin', function() {
+    var cell = $(this);
+    cell.data('originalHtml', cell.html());
+    cell.data('dirty', false);
+  });
+
+  $('table td.cell[contenteditable]').on('input', function() {
+    $(this).data('dirty', true);
+  });
+
+  $('table td.cell[contenteditable]').on('focusout', function() {
+    var cell = $(this);
+    if (!cell.data('dirty')) {
+      // Only clicked, nothing typed: put the old value back
+      cell.html(cell.data('originalHtml'));
+      return;
+    }
+    var newValue = cell.text();
+    enqueue(cell, {
+      column: $('thead th').eq(cell.index()).data('column'),
+      value: newValue.toUpperCase() === 'NULL' ? null : newValue
+    });
   });
 
-  $('table td').on('focusout', function() {
-    $(this).removeAttr('contenteditable');
-    // Получаем новое значение ячейки
-    var newValue = $(this).text();
-    // Получаем данные о столбце и строке
-    var columnIndex = $(this).index();
-    var rowIndex = $(this).parent().index();
-    var columnLabel = $('thead th').eq(columnIndex).text();
-    var rowLabel = $('tbody tr').eq(rowIndex).find('td').first().text();
-    var table = $('#your_table').data('table');
-    if ($(this).data('originalValue') !== newValue) {
-      $.ajax({
-        type: 'POST',
-        url: '/apply_changes',
-        data: {
-          table_name: table,
-          columnLabel: columnLabel,
-          rowLabel: rowLabel,
-          newValue: newValue
-        },
-        success: function(response) {
-          console.log('Данные успешно отправлены на сервер.');
-        },
-        error: function(error) {
-          console.error('Произошла ошибка при отправке данных на сервер:', error);
-        }
-      });
+  $(window).on('beforeunload', function() {
+    if (queue.length) {
+      navigator.sendBeacon(changesUrl, new Blob([payload(queue)], {type: 'application/json'}));
+      queue = [];
     }
   });
 });
@@ -1,14 +1,15 @@
 $(function() {
-  $('.column-filter').on('input', function() {
-    var columnIndex = $(this).data('column');
-    var filterValue = $(this).val().toLowerCase();
-    $('table tbody tr').each(function() {
-      var cellValue = $(this).find('td').eq(columnIndex).text().toLowerCase();
-      if (cellValue.includes(filterValue)) {
-        $(this).show();
-      } else {
-        $(this).hide();
-      }
+  // Filters run on the server: Enter in any column filter applies them all
+  $('.column-filter').on('keydown', function(e) {
+    if (e.key === 'Enter') {
+      e.preventDefault();
+      $('#filter-form').submit();
+    }
+  });
+  // Leave empty filters out of the URL
+  $('#filter-form').on('submit', function() {
+    $('.column-filter, #filter-form input[name="q"]').each(function() {
+      $(this).prop('disabled', !$(this).val().trim());
     });
   });
-  });
\ No newline at end of file
+});
@@ -0,0 +1,100 @@
+$(function() {
+  // Browsing grid: rows come from the row API a window at a time and only the
+  // rows in view (plus OVERSCAN on each side) are in the DOM
+  var grid = $('#grid');
+  if (!grid.length) {
+    return;
+  }
+  // ROWS_API_LIMIT rows per request
+  var WINDOW = grid.data('window');
+  var OVERSCAN = 30;
+  var rowHeight = 30;
+  var url = grid.data('rowsUrl');
+  var tbody = grid.find('tbody');
+  var status = $('.grid-status');
+  var width = grid.find('thead th').length;
+  var data = [];
+  var loaded = 0;
+  // The page counted the rows already, so the row API doesn't have to
+  var total = grid.data('count');
+  var next = {};
+  var loading = false;
+  var done = false;
+  var scheduled = false;
+
+  function escapeHtml(value) {
+    return String(value).replace(/[&<>"']/g, function(c) {
+      return {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c];
+    });
+  }
+
+  function load() {
+    if (loading || done) {
+      return;
+    }
+    loading = true;
+    $.getJSON(url, $.extend({limit: WINDOW, count: 0}, next)).done(function(response) {
+      if (!data.length) {
+        data = $.map(response.columns, function() { return [[]]; });
+      }
+      $.each(response.data, function(i, values) {
+        Array.prototype.push.apply(data[i], values);
+      });
+      loaded += response.rows;
+      if (response.count !== undefined) {
+        total = response.count;
+      }
+      next = response.next;
+      done = !next;
+      loading = false;
+      render();
+    }).fail(function(xhr) {
+      loading = false;
+      done = true;
+      status.text((xhr.responseJSON && xhr.responseJSON.error) || 'The rows could not be loaded');
+    });
+  }
+
+  function spacer(rows) {
+    return rows > 0 ? '<tr class="grid-spacer" style="height: ' + rows * rowHeight + 'px"><td colspan="' + width + '"></td></tr>' : '';
+  }
+
+  function render() {
+    scheduled = false;
+    var top = grid.scrollTop();
+    var first = Math.max(0, Math.floor(top / rowHeight) - OVERSCAN);
+    var last = Math.min(loaded, Math.ceil((top + grid.height()) / rowHeight) + OVERSCAN);
+    // Until everything is loaded, the scrollbar is sized for the estimated row count
+    var expected = done ? loaded : Math.max(loaded + 1, total || 0);
+    var html = [spacer(first)];
+    for (var row = first; row < last; row++) {
+      html.push('<tr class="grid-row' + (row % 2 ? '' : ' grid-odd') + '">');
+      for (var column = 0; column < data.length; column++) {
+        var value = data[column][row];
+        html.push(value === null ? '<td><i style="color: darkgrey">Null</i></td>'
+                                 : '<td title="' + escapeHtml(value) + '">' + escapeHtml(value) + '</td>');
+      }
+      html.push('</tr>');
+    }
+    html.push(spacer(expected - last));
+    tbody.html(html.join(''));
+    var measured = tbody.find('tr.grid-row').first().outerHeight();
+    if (measured && measured !== rowHeight) {
+      rowHeight = measured;
+      return render();
+    }
+    status.text(loaded.toLocaleString() + (done ? '' : ' of ' + (total === null ? '?' : '≈ ' + total.toLocaleString())) + ' rows loaded');
+    if (!done && last >= loaded - OVERSCAN) {
+      load();
+    }
+  }
+
+  grid.on('scroll', function() {
+    if (!scheduled) {
+      scheduled = true;
+      window.requestAnimationFrame(render);
+    }
+  });
+  $(window).on('resize', render);
+  load();
+});
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+from psycopg2 import sql as pg_sql
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def render_sql(composable):
+    # as_string() needs a live connection to quote identifiers
+    if isinstance(composable, pg_sql.Composed):
+        return ''.join(render_sql(part) for part in composable.seq)
+    if isinstance(composable, pg_sql.Identifier):
+        return '.'.join('"%s"' % name.replace('"', '""') for name in composable.strings)
+    if isinstance(composable, pg_sql.Placeholder):
+        return '%s' if composable.name is None else '%%(%s)s' % composable.name
+    return composable.string
+
+
+@pytest.fixture
+def sql_text():
+    return render_sql
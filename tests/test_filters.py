@@ -0,0 +1,48 @@
+import pytest
+
+import main
+
+NAME = main.Column('name', 'text', True, None, False, 'text')
+AGE = main.Column('age', 'integer', True, None, False, 'integer')
+
+
+@pytest.mark.parametrize('column, expression, kind, condition, params', [
+    (AGE, 'null', 'null', '"age" IS NULL', []),
+    (AGE, ' !null ', 'null', '"age" IS NOT NULL', []),
+    (AGE, '=5', 'equality', '"age" = %s::integer', ['5']),
+    (AGE, '!= 5', 'range', '"age" <> %s::integer', ['5']),
+    (AGE, '>=18', 'range', '"age" >= %s::integer', ['18']),
+    (AGE, '18..65', 'range', '"age" >= %s::integer AND "age" <= %s::integer', ['18', '65']),
+    (AGE, '..65', 'range', '"age" <= %s::integer', ['65']),
+    (AGE, '42', 'equality', '"age" = %s::integer', ['42']),
+    (NAME, '50%_off', 'substring', '"name" ILIKE %s', ['%50\\%\\_off%']),
+    (NAME, '=Ann', 'equality', '"name" = %s::text', ['Ann']),
+])
+def test_parse_filter(sql_text, column, expression, kind, condition, params):
+    predicate = main.parse_filter(column, expression)
+    assert predicate.columns == [column.name]
+    assert predicate.kind == kind
+    assert sql_text(predicate.condition) == condition
+    assert predicate.params == params
+
+
+def test_index_hints_skip_served_predicates():
+    indexes = [main.Index('people_age_idx', ['age'], False, False,
+                          'CREATE INDEX people_age_idx ON public.people USING btree (age)'),
+               main.Index('people_name_trgm', ['name'], False, False,
+                          'CREATE INDEX people_name_trgm ON public.people USING gin (name gin_trgm_ops)')]
+    predicates = [main.parse_filter(AGE, '>18'), main.parse_filter(NAME, 'ann')]
+    assert main.index_hints('people', predicates, indexes) == []
+
+
+def test_index_hints_suggest_missing_indexes():
+    # A btree index on name does not serve ILIKE, and age is not its first column
+    indexes = [main.Index('people_name_age_idx', ['name', 'age'], False, False,
+                          'CREATE INDEX people_name_age_idx ON public.people USING btree (name, age)')]
+    predicates = [main.parse_filter(AGE, '>18'), main.parse_filter(NAME, 'ann')]
+    hints = main.index_hints('people', predicates, indexes)
+    assert [(column, args) for column, _, _, args in hints] == [
+        ('age', {'indexed_columns': 'age'}),
+        ('name', {'indexed_columns': 'name', 'method': 'gin', 'opclass': 'gin_trgm_ops'}),
+    ]
+    assert hints[0][2] == 'CREATE INDEX CONCURRENTLY ON "people" ("age");'
@@ -0,0 +1,96 @@
+import io
+from contextlib import contextmanager
+
+import main
+
+
+class FakeTools():
+
+    def get_table_info(self, table):
+        return [main.Column('id', 'integer', False, None, True, 'integer'),
+                main.Column('name', 'text', True, None, False, 'text')]
+
+
+def jsonl_records(text):
+    task = main.ImportTask(FakeTools(), 'people', None, 'jsonl')
+    return task, list(task._jsonl_records(io.StringIO(text)))
+
+
+def test_jsonl_ignores_unmapped_keys():
+    task, records = jsonl_records('{"id": 1, "name": "a", "extra": 5}\n'
+                                  '{"id": 2, "name": "b", "extra": 6, "later": true}\n')
+    assert task.columns == ['id', 'name']
+    assert task.ignored_columns == ['extra']
+    assert [(values, error) for _, values, error in records] == [(['1', 'a'], None), (['2', 'b'], None)]
+
+
+def test_jsonl_missing_keys_are_null():
+    _, records = jsonl_records('{"id": 1, "name": "a"}\n{"id": 2}\n')
+    assert [values for _, values, _ in records] == [['1', 'a'], ['2', None]]
+
+
+def test_jsonl_rejects_bad_lines():
+    _, records = jsonl_records('{"id": 1}\nnot json\n[1, 2]\n')
+    errors = [error for _, _, error in records]
+    assert errors[0] is None
+    assert errors[1].startswith('Invalid JSON')
+    assert errors[2] == 'Not a JSON object'
+
+
+
+class FakeCursor():
+
+    def __init__(self, copied):
+        self.copied = copied
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql):
+        pass
+
+    def copy_expert(self, sql, file):
+        self.copied.append(file.read())
+
+
+class FakeConnection():
+
+    def __init__(self):
+        self.copied = []
+
+    def cursor(self):
+        return FakeCursor(self.copied)
+
+    def commit(self):
+        pass
+
+
+class CopyingTools(FakeTools):
+
+    def __init__(self):
+        self.conn = FakeConnection()
+
+    @contextmanager
+    def connection(self):
+        yield self.conn
+
+    def invalidate_row_count(self, table):
+        pass
+
+    def release(self):
+        pass
+
+
+def test_csv_header_byte_order_mark(tmp_path):
+    # As Excel saves CSV files
+    path = tmp_path / 'people.csv'
+    path.write_bytes('id,name\n1,a\n'.encode('utf-8-sig'))
+    tools = CopyingTools()
+    task = main.ImportTask(tools, 'people', str(path), 'csv')
+    task.run()
+    assert task.status == 'finished'
+    assert task.columns == ['id', 'name']
+    assert tools.conn.copied == ['"1","a"\n']
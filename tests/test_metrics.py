@@ -0,0 +1,19 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ("SELECT * FROM t WHERE id = 42 AND name = 'x''y'", 'SELECT * FROM t WHERE id = ? AND name = ?'),
+    ('select  *\n from t where id in (1, 2, 3)', 'select * from t where id in (...)'),
+    ("INSERT INTO t VALUES (1, 'a'), (2, 'b'), (3, 'c')", 'INSERT INTO t VALUES (...), ...'),
+    ('SELECT $1, true, NULL -- note\n', 'SELECT ?, ?, ?'),
+    ('SELECT 1.5e3, col2 FROM t2 /* hint */', 'SELECT ?, col2 FROM t2'),
+])
+def test_fingerprint(sql, expected):
+    assert main.fingerprint(sql) == expected
+
+
+def test_fingerprint_groups_repeats():
+    assert main.fingerprint('SELECT * FROM users WHERE id = 1') == \
+        main.fingerprint('SELECT *  FROM users WHERE id = 2')
@@ -0,0 +1,35 @@
+import main
+
+
+def test_seek_condition_uses_row_comparison_without_nulls(sql_text):
+    condition, params = main.seek_condition([('id', False, False)], [5])
+    assert sql_text(condition) == '("id") > (%s)'
+    assert params == [5]
+
+    condition, params = main.seek_condition([('a', True, False), ('b', True, False)], [1, 2])
+    assert sql_text(condition) == '("a", "b") < (%s, %s)'
+    assert params == [1, 2]
+
+
+def test_seek_condition_ascending_nulls_last(sql_text):
+    condition, params = main.seek_condition([('a', False, True), ('id', False, False)], [7, 3])
+    assert sql_text(condition) == ('((("a" > %s OR "a" IS NULL)) OR '
+                                   '("a" = %s AND ("id" > %s OR "id" IS NULL)))')
+    assert params == [7, 7, 3]
+
+    # Past a NULL only rows with the same NULL and a later key follow
+    condition, params = main.seek_condition([('a', False, True), ('id', False, False)], [None, 3])
+    assert sql_text(condition) == '(("a" IS NULL AND ("id" > %s OR "id" IS NULL)))'
+    assert params == [3]
+
+
+def test_seek_condition_descending_nulls_first(sql_text):
+    condition, params = main.seek_condition([('a', True, True), ('id', True, False)], [None, 3])
+    assert sql_text(condition) == '(("a" IS NOT NULL) OR ("a" IS NULL AND "id" < %s))'
+    assert params == [3]
+
+
+def test_seek_condition_nothing_after_last_null(sql_text):
+    condition, params = main.seek_condition([('a', False, True)], [None])
+    assert sql_text(condition) == 'FALSE'
+    assert params == []
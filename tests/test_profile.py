@@ -0,0 +1,58 @@
+import pytest
+
+import main
+
+
+def scan(relation, time, rows, plan_rows, hit=0, read=0, loops=1):
+    return {'Node Type': 'Seq Scan', 'Relation Name': relation, 'Alias': relation, 'Plan Rows': plan_rows,
+            'Total Cost': 100.0, 'Actual Total Time': time, 'Actual Rows': rows, 'Actual Loops': loops,
+            'Shared Hit Blocks': hit, 'Shared Read Blocks': read}
+
+
+ANALYZED = {
+    'Planning Time': 0.2,
+    'Execution Time': 10.5,
+    'Plan': {
+        'Node Type': 'Hash Join', 'Join Type': 'Inner', 'Plan Rows': 10, 'Total Cost': 300.0,
+        'Actual Total Time': 10.0, 'Actual Rows': 1000, 'Actual Loops': 1,
+        'Shared Hit Blocks': 30, 'Shared Read Blocks': 12,
+        'Plans': [
+            scan('orders', 4.0, 1000, 1000, hit=20, read=2),
+            {'Node Type': 'Hash', 'Plan Rows': 50, 'Total Cost': 150.0, 'Actual Total Time': 5.0,
+             'Actual Rows': 50, 'Actual Loops': 1, 'Shared Hit Blocks': 10, 'Shared Read Blocks': 10,
+             'Plans': [scan('users', 0.9, 10, 50, hit=10, read=10, loops=5)]},
+        ],
+    },
+}
+
+
+def test_profile_plan_exclusive_times():
+    profile = main.profile_plan(ANALYZED)
+    assert profile.analyzed
+    assert (profile.planning_time, profile.execution_time, profile.total) == (0.2, 10.5, 10.0)
+    assert [(node.depth, node.label) for node in profile.nodes] == [
+        (0, 'Hash Join'), (1, 'Seq Scan on orders'), (1, 'Hash'), (2, 'Seq Scan on users')]
+    # Per-loop times and rows are multiplied by the loops
+    assert [node.total for node in profile.nodes] == pytest.approx([10.0, 4.0, 5.0, 4.5])
+    assert [node.exclusive for node in profile.nodes] == pytest.approx([1.0, 4.0, 0.5, 4.5])
+    assert profile.nodes[3].actual_rows == 50
+    assert [(node.shared_hit, node.shared_read) for node in profile.nodes] == [(0, 0), (20, 2), (0, 0), (10, 10)]
+
+
+def test_profile_plan_flags_hot_nodes_and_misestimates():
+    profile = main.profile_plan(ANALYZED, hot_nodes=2, hot_share=0.1)
+    assert [node.hot for node in profile.nodes] == [False, True, False, True]
+    assert profile.nodes[0].misestimate == pytest.approx(100)
+    assert profile.nodes[1].misestimate == pytest.approx(1)
+
+
+def test_profile_plan_without_analyze_uses_costs():
+    plan = {'Plan': {'Node Type': 'Limit', 'Plan Rows': 10, 'Total Cost': 12.0,
+                     'Plans': [{'Node Type': 'Index Scan', 'Index Name': 'users_pkey', 'Relation Name': 'users',
+                                'Alias': 'u', 'Plan Rows': 10, 'Total Cost': 9.0}]}}
+    profile = main.profile_plan(plan)
+    assert not profile.analyzed
+    assert [node.label for node in profile.nodes] == ['Limit', 'Index Scan using users_pkey on users u']
+    assert [node.exclusive for node in profile.nodes] == [3.0, 9.0]
+    assert [node.actual_rows for node in profile.nodes] == [None, None]
+    assert profile.nodes[1].share == pytest.approx(0.75)
@@ -0,0 +1,43 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize('sql', [
+    'SELECT 1',
+    'select * from users;',
+    "SELECT 'a;b'",
+    "SELECT 'insert into x' AS note",
+    'SELECT "into" FROM t',
+    "SELECT $$ ; delete from t $$",
+    "SELECT E'it\\'s; fine'",
+    '-- leading comment\nSELECT 1',
+    '/* into; */ WITH a AS (SELECT 1) SELECT * FROM a',
+    'VALUES (1), (2)',
+    'TABLE users',
+    'SELECT * FROM t FOR UPDATE',
+])
+def test_read_queries(sql):
+    assert main.is_read_query(sql)
+
+
+@pytest.mark.parametrize('sql', [
+    'SELECT * INTO copy FROM users',
+    'WITH d AS (DELETE FROM t RETURNING *) SELECT * FROM d',
+    'WITH u AS (UPDATE t SET a = 1 RETURNING *) SELECT * FROM u',
+    'WITH u AS (UPDATE t AS x SET a = 1 RETURNING *) SELECT * FROM u',
+    'WITH i AS (INSERT INTO t VALUES (1) RETURNING *) SELECT * FROM i',
+    'SELECT 1; SELECT 2',
+    "SELECT 'a'; DROP TABLE t",
+    'UPDATE t SET a = 1',
+    'DELETE FROM t',
+])
+def test_write_queries(sql):
+    assert not main.is_read_query(sql)
+
+
+def test_index_name_fits_identifier_limit():
+    assert main.index_name('users', ['email']) == 'users_email_idx'
+    name = main.index_name('пользователи_с_очень_длинным_именем', ['электронная_почта'])
+    assert len(name.encode('utf-8')) <= 63
+    assert name == 'пользователи_с_очень_длинным_им_idx'